@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""Generate deterministic corpus of test images.
+
+Each base image is accompanied by variants, which should be reported
+as duplicates of it:
+
+* resized: scaled down to 50 %
+* recompressed: saved again with lower JPEG quality
+* cropped: 5 % cut off each edge
+* retagged: same pixels, different EXIF data (binary different)
+* copy: byte-identical copy (binary equal)
+
+The same seed always produces the same files. Ground truth is written
+to 'manifest.json' in the output directory.
+
+Run from top directory:
+
+    python3 -m benchmarks.corpus -n 100 /tmp/corpus
+
+Requires PIL.
+
+"""
+
+from argparse import ArgumentParser
+import os.path
+import random
+import shutil
+import json
+
+from PIL import Image, ImageDraw
+
+
+VARIANTS = ['resized', 'recompressed', 'cropped', 'retagged', 'copy']
+
+
+def make_base_image(rng, width, height):
+    """Draw random shapes over gradient background."""
+    image = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', [image.rotate(rng.randrange(360))
+                                for _ in range(3)])
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(10, 30)):
+        x0, x1 = sorted(rng.randrange(width) for _ in range(2))
+        y0, y1 = sorted(rng.randrange(height) for _ in range(2))
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle([x0, y0, x1, y1], fill=fill)
+        else:
+            draw.ellipse([x0, y0, x1, y1], fill=fill)
+    return image
+
+
+def make_variant(variant, base_path, image, path, rng):
+    if variant == 'resized':
+        image.resize((image.width // 2, image.height // 2)).save(path,
+                                                                 quality=90)
+    elif variant == 'recompressed':
+        image.save(path, quality=rng.randint(40, 70))
+    elif variant == 'cropped':
+        dx, dy = image.width // 20, image.height // 20
+        image.crop((dx, dy, image.width - dx, image.height - dy)).save(
+            path, quality=90)
+    elif variant == 'retagged':
+        exif = Image.Exif()
+        exif[0x010e] = 'retagged %s' % rng.randrange(1 << 30)  # description
+        image.save(path, quality=90, exif=exif)
+    elif variant == 'copy':
+        shutil.copyfile(base_path, path)
+
+
+def generate_corpus(outdir, count, seed=0, width=1024, height=768):
+    """Generate `count` base images and their variants into `outdir`.
+
+    Returns manifest: list of groups, each group is a dict with base file
+    name and file names of variants (relative to `outdir`).
+
+    """
+    rng = random.Random(seed)
+    manifest = []
+    for n in range(count):
+        subdir = 'set%03d' % (n // 100)
+        os.makedirs(os.path.join(outdir, subdir), exist_ok=True)
+        base_name = os.path.join(subdir, 'base%05d.jpg' % n)
+        base_path = os.path.join(outdir, base_name)
+        image = make_base_image(rng, width, height)
+        image.save(base_path, quality=90)
+        group = {'base': base_name, 'variants': {}}
+        for variant in VARIANTS:
+            name = os.path.join(subdir, '%s%05d.jpg' % (variant, n))
+            make_variant(variant, base_path, image,
+                         os.path.join(outdir, name), rng)
+            group['variants'][variant] = name
+        manifest.append(group)
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent='\t')
+    return manifest
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('outdir', help='Output directory')
+    ap.add_argument('-n', '--count', type=int, default=100,
+                    help='Number of base images. Default: %(default)s')
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help='Random seed. Default: %(default)s')
+    args = ap.parse_args()
+    generate_corpus(args.outdir, args.count, args.seed)
+
+
+if __name__ == '__main__':
+    main()
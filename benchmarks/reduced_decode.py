@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Compare perceptual hashes computed from full and reduced-scale decode.
+
+For each image, hash is computed both ways and the distance between
+the two hashes is measured. Agreement is the ratio of images for which
+the distance stays within the similarity threshold, i.e. the image would
+still be matched with itself.
+
+Run from top directory:
+
+    python3 -m benchmarks.reduced_decode -r ~/Pictures
+
+"""
+
+from argparse import ArgumentParser
+import os.path
+import time
+import json
+
+from dedupimages.imagehash import ImageHash
+from dedupimages.dedupimages import DedupImages
+
+
+def list_images(paths, recursive):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for dirpath, _dirnames, filenames in os.walk(path):
+            for fname in sorted(filenames):
+                _root, ext = os.path.splitext(fname)
+                if ext.lower() in DedupImages.FORMATS:
+                    yield os.path.join(dirpath, fname)
+            if not recursive:
+                break
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_algorithm(algorithm, filenames, threshold):
+    imagehash_class = ImageHash.get_subclass(algorithm)
+    full_time = reduced_time = 0.0
+    distances = []
+    for filename in filenames:
+        full, reduced = imagehash_class(), imagehash_class()
+        try:
+            file_full_time = timed(full.compute, filename)
+            file_reduced_time = timed(reduced.compute_reduced, filename)
+        except IOError:
+            continue
+        full_time += file_full_time
+        reduced_time += file_reduced_time
+        distances.append(full.distance(reduced))
+    if not distances:
+        return None
+    return {
+        'algorithm': algorithm,
+        'images': len(distances),
+        'full_time': full_time,
+        'reduced_time': reduced_time,
+        'speedup': full_time / reduced_time if reduced_time else None,
+        'mean_distance': sum(distances) / len(distances),
+        'max_distance': max(distances),
+        'agreement': sum(1 for d in distances if d <= threshold) / len(distances),
+    }
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('path', nargs='+', help='Image files or directories')
+    ap.add_argument('-r', '--recursive', action='store_true',
+                    help='Recursively traverse into subdirectories')
+    ap.add_argument('-a', '--algorithm', action='append',
+                    help='Algorithm to benchmark (repeatable). '
+                         'Default: all')
+    ap.add_argument('-t', '--threshold', type=float, default=90.0,
+                    help='Minimal similarity ratio. Default: %(default)s%%')
+    ap.add_argument('--json', action='store_true',
+                    help='Print results as JSON')
+    args = ap.parse_args()
+    filenames = list(list_images(args.path, args.recursive))
+    threshold = 1.0 - (args.threshold / 100)
+    algorithms = args.algorithm or ['dct', 'mh', 'radial']
+    results = [bench_algorithm(algorithm, filenames, threshold)
+               for algorithm in algorithms]
+    results = [r for r in results if r]
+    if args.json:
+        print(json.dumps(results, indent='\t'))
+        return
+    for r in results:
+        print('{algorithm:6} {images:6d} images  '
+              'full {full_time:8.2f}s  reduced {reduced_time:8.2f}s  '
+              'speedup {speedup:5.1f}x  '
+              'distance mean {mean_distance:.3f} max {max_distance:.3f}  '
+              'agreement {agreement:.1%}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""End-to-end benchmark suite.
+
+Cases:
+
+* hash: DedupImages.cmd_hash over image corpus (files/s)
+* add: HashDB.add over image corpus, binary fingerprints only (files/s)
+* load, save: load_database / save_database of synthetic DB (items/s)
+* search: HashDB.find_groups over synthetic DB (comparisons/s)
+* query: HashDB.query over synthetic DB (comparisons/s)
+* startup: cold start of dedup-images.py --help (starts/s)
+* startup_db: cold start of dedup-images.py --search, loading synthetic DB
+  and searching in path which is not in DB (starts/s)
+
+Each case runs in separate process, so that its peak RSS can be measured.
+Results are printed as JSON. Use '--save' to store them as a baseline
+and '--baseline' to compare with it later. Cases slower than baseline
+by more than the tolerance are reported as regressions (exit code 1).
+
+Run from top directory:
+
+    python3 -m benchmarks.suite --sizes 1000,10000 --save baseline.json
+    python3 -m benchmarks.suite --sizes 1000,10000 --baseline baseline.json
+
+"""
+
+from argparse import ArgumentParser
+import multiprocessing
+import contextlib
+import subprocess
+import platform
+import resource
+import tempfile
+import os.path
+import time
+import json
+import sys
+
+from benchmarks import corpus, synthetic
+
+
+def _run_case(conn, case, params):
+    """Run benchmark case in child process, send result to `conn`."""
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        try:
+            count, unit, seconds = CASES[case](**params)
+        except Exception as e:
+            conn.send({'error': '%s: %s' % (type(e).__name__, e)})
+            return
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send({
+        'count': count,
+        'unit': unit,
+        'seconds': seconds,
+        'rate': count / seconds if seconds else None,
+        'peak_rss_mb': rss_kb / 1024,
+    })
+
+
+def run_case(case, **params):
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case, args=(child_conn, case, params))
+    process.start()
+    # Only the child writes, so recv() fails when it dies without result
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode:
+        result = {'error': 'Case process failed (exit code %s)'
+                           % process.exitcode}
+    result['case'] = case
+    result.update(params)
+    return result
+
+
+def _make_program(algorithm, dbpath):
+    from dedupimages.dedupimages import DedupImages
+    from dedupimages.config import Config
+    cfg = Config()
+    cfg.algorithm = algorithm
+    cfg.dbpath = dbpath
+    return DedupImages(cfg)
+
+
+def _list_corpus(corpus_dir):
+    return [os.path.join(dirpath, fname)
+            for dirpath, _dirnames, filenames in os.walk(corpus_dir)
+            for fname in filenames if fname.endswith('.jpg')]
+
+
+def case_hash(algorithm, corpus_dir, workdir):
+    prog = _make_program(algorithm, os.path.join(workdir, 'hash.hashdb'))
+    files = _list_corpus(corpus_dir)
+    start = time.perf_counter()
+    prog.cmd_hash(corpus_dir, recursive=True)
+    return len(files), 'files/s', time.perf_counter() - start
+
+
+def case_add(algorithm, corpus_dir, workdir):
+    from dedupimages.hashdb import HashDB
+    hashdb = HashDB()
+    files = _list_corpus(corpus_dir)
+    start = time.perf_counter()
+    for filename in files:
+        hashdb.add(filename)
+    return len(files), 'files/s', time.perf_counter() - start
+
+
+def _synthetic_db(algorithm, items, workdir):
+    path = os.path.join(workdir, 'synthetic-%s-%s.hashdb' % (algorithm, items))
+    if not os.path.exists(path):
+        synthetic.write_db(path, items, [algorithm])
+    return path
+
+
+def case_load(algorithm, items, workdir):
+    prog = _make_program(algorithm, _synthetic_db(algorithm, items, workdir))
+    start = time.perf_counter()
+    prog.load_database(must_exist=True)
+    return items, 'items/s', time.perf_counter() - start
+
+
+def case_save(algorithm, items, workdir):
+    prog = _make_program(algorithm, _synthetic_db(algorithm, items, workdir))
+    prog.load_database(must_exist=True)
+    prog.dbpath = os.path.join(workdir, 'save.hashdb')
+    # Output of previous run would be merged instead of overwritten
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(prog.dbpath)
+    start = time.perf_counter()
+    prog.save_database()
+    return items, 'items/s', time.perf_counter() - start
+
+
+def case_search(algorithm, items, workdir):
+    prog = _make_program(algorithm, _synthetic_db(algorithm, items, workdir))
+    prog.load_database(must_exist=True)
+    start = time.perf_counter()
+    for _group in prog.hashdb.find_groups(0.1, algorithm):
+        pass
+    comparisons = items * (items - 1) // 2
+    return comparisons, 'comparisons/s', time.perf_counter() - start
+
+
+def case_query(algorithm, items, workdir):
+    prog = _make_program(algorithm, _synthetic_db(algorithm, items, workdir))
+    prog.load_database(must_exist=True)
+    sample_hash = prog.hashdb.items[0].image_hash[algorithm]
+    start = time.perf_counter()
+    for _result in prog.hashdb.query(sample_hash, 0.1, algorithm):
+        pass
+    return items, 'comparisons/s', time.perf_counter() - start
+
+
+STARTUP_REPEAT = 5
+
+
+def _cold_start(args):
+    """Run dedup-images.py in new interpreter `STARTUP_REPEAT` times."""
+    script = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'dedup-images.py')
+    start = time.perf_counter()
+    for _ in range(STARTUP_REPEAT):
+        subprocess.run([sys.executable, script] + args, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return STARTUP_REPEAT, 'starts/s', time.perf_counter() - start
+
+
+def case_startup(algorithm, corpus_dir, workdir):
+    return _cold_start(['--help'])
+
+
+def case_startup_db(algorithm, items, workdir):
+    dbpath = _synthetic_db(algorithm, items, workdir)
+    return _cold_start(['--search', '--skip-bin', '-q', '-a', algorithm,
+                        '--db', dbpath, os.path.join(workdir, 'not-in-db')])
+
+
+CASES = {
+    'hash': case_hash,
+    'add': case_add,
+    'load': case_load,
+    'save': case_save,
+    'search': case_search,
+    'query': case_query,
+    'startup': case_startup,
+    'startup_db': case_startup_db,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Compare `results` with `baseline`. Returns list of regressions."""
+    def key(r):
+        return r['case'], r['algorithm'], r.get('items')
+    baseline_rates = {key(r): r.get('rate') for r in baseline['results']}
+    regressions = []
+    for r in results:
+        base_rate = baseline_rates.get(key(r))
+        if not base_rate or not r.get('rate'):
+            continue
+        r['baseline_rate'] = base_rate
+        r['ratio'] = r['rate'] / base_rate
+        if r['ratio'] < 1.0 - tolerance:
+            regressions.append(r)
+    return regressions
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('-c', '--case', action='append', choices=sorted(CASES),
+                    help='Case to run (repeatable). Default: all')
+    ap.add_argument('-a', '--algorithm', action='append',
+                    help='Algorithm (repeatable). Default: dct, mh, radial')
+    ap.add_argument('--sizes', default='1000,10000,100000',
+                    help='Synthetic DB sizes. Default: %(default)s')
+    ap.add_argument('--max-search', type=int, default=20000,
+                    help='Skip all-pairs search on bigger DBs. '
+                         'Default: %(default)s')
+    ap.add_argument('--corpus', help='Image corpus directory '
+                                     '(default: generate into workdir)')
+    ap.add_argument('--corpus-size', type=int, default=20,
+                    help='Number of base images in generated corpus. '
+                         'Default: %(default)s')
+    ap.add_argument('--workdir', help='Directory for generated data '
+                                      '(default: temporary)')
+    ap.add_argument('--save', metavar='FILE', help='Save results to FILE')
+    ap.add_argument('--baseline', metavar='FILE',
+                    help='Compare results with baseline FILE')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+                    help='Allowed slowdown against baseline. '
+                         'Default: %(default)s')
+    args = ap.parse_args()
+    cases = args.case or list(CASES)
+    algorithms = args.algorithm or ['dct', 'mh', 'radial']
+    sizes = [int(s) for s in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+        corpus_dir = args.corpus
+        if not corpus_dir and ('hash' in cases or 'add' in cases):
+            corpus_dir = os.path.join(workdir, 'corpus')
+            if not os.path.exists(corpus_dir):
+                corpus.generate_corpus(corpus_dir, args.corpus_size)
+        results = []
+        for case in cases:
+            for algorithm in algorithms:
+                if case in ('hash', 'add', 'startup'):
+                    if case != 'hash' and algorithm != algorithms[0]:
+                        continue  # Not dependent on algorithm
+                    results.append(run_case(case, algorithm=algorithm,
+                                            corpus_dir=corpus_dir,
+                                            workdir=workdir))
+                    continue
+                for items in sizes:
+                    if case == 'search' and items > args.max_search:
+                        continue
+                    results.append(run_case(case, algorithm=algorithm,
+                                            items=items, workdir=workdir))
+    for r in results:
+        r.pop('workdir', None)
+        r.pop('corpus_dir', None)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report['regressions'] = len(regressions)
+    print(json.dumps(report, indent='\t'))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent='\t')
+    for r in regressions:
+        print('Regression: %(case)s %(algorithm)s %(items)s: '
+              '%(ratio).2f of baseline rate' % dict(r, items=r.get('items', '')),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""Generate synthetic hash database without any image files.
+
+Items have random content digests and perceptual hashes. One in ten items
+is a near-duplicate of a previous item (few bits of the hash changed),
+so that search has something to report. File names are spread over
+directory tree, like a photo library.
+
+The database is written as a stream, so even 10^7 items can be generated
+without holding them in memory.
+
+Run from top directory:
+
+    python3 -m benchmarks.synthetic -n 1000000 /tmp/synthetic.hashdb
+
+"""
+
+from argparse import ArgumentParser
+import random
+import json
+import gzip
+
+
+# Hash length in bytes for each algorithm
+HASH_BYTES = {'dct': 8, 'mh': 72, 'radial': 40}
+
+
+def _perturb(rng, value, nbytes, bits):
+    for _ in range(bits):
+        value ^= 1 << rng.randrange(nbytes * 8)
+    return value
+
+
+def synthetic_items(count, algorithms=('mh',), seed=0, dup_ratio=0.1):
+    """Generate `count` item dicts as dumped by HashItem.dump()."""
+    rng = random.Random(seed)
+    bases = {algorithm: [] for algorithm in algorithms}
+    for n in range(count):
+        year, album = 2000 + n % 20, n // 500
+        d = {
+            'names': ['/photos/%d/album%05d/IMG_%07d.jpg' % (year, album, n)],
+            'size': rng.randint(100000, 10000000),
+            'first_512b_sha256': '%064x' % rng.getrandbits(256),
+            'sha256': '%064x' % rng.getrandbits(256),
+        }
+        duplicate = n and rng.random() < dup_ratio
+        for algorithm in algorithms:
+            nbytes = HASH_BYTES[algorithm]
+            if duplicate:
+                value = _perturb(rng, rng.choice(bases[algorithm]), nbytes,
+                                 bits=max(1, nbytes // 8))
+            else:
+                value = rng.getrandbits(nbytes * 8)
+                if len(bases[algorithm]) < 10000:
+                    bases[algorithm].append(value)
+            d['ph_' + algorithm] = '%0*X' % (nbytes * 2, value)
+        yield d
+
+
+def write_db(path, count, algorithms=('mh',), seed=0):
+    """Write synthetic database with `count` items to `path`."""
+    with gzip.open(path, 'wt', encoding='utf8') as f:
+        f.write('[')
+        for n, d in enumerate(synthetic_items(count, algorithms, seed)):
+            if n:
+                f.write(',\n')
+            json.dump(d, f)
+        f.write(']\n')
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('dbpath', help='Output hash database')
+    ap.add_argument('-n', '--count', type=int, default=1000,
+                    help='Number of items. Default: %(default)s')
+    ap.add_argument('-a', '--algorithm', action='append',
+                    help='Hash algorithm (repeatable). Default: mh')
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help='Random seed. Default: %(default)s')
+    args = ap.parse_args()
+    write_db(args.dbpath, args.count, args.algorithm or ['mh'], args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+ARCHIVE_FORMATS = ['.zip', '.tar', '.tgz', '.tar.gz', '.tar.bz2', '.tar.xz']
+
+# Separates archive file name from member name: 'photos.zip!/a/b.jpg'
+SEPARATOR = '!/'
+
+
+def is_archive(fname):
+    return fname.lower().endswith(tuple(ARCHIVE_FORMATS))
+
+
+def split_member_name(filename):
+    """Split `filename` into archive path and member name.
+
+    Returns tuple (archive_path, member_name). If `filename` doesn't refer
+    to archive member, returns (filename, None).
+
+    """
+    archive_path, sep, member_name = filename.partition(SEPARATOR)
+    if sep and is_archive(archive_path):
+        return archive_path, member_name
+    return filename, None
+
+
+def outer_path(filename):
+    """Return path of the file in filesystem, i.e. archive for its members."""
+    return split_member_name(filename)[0]
+
+
+def iter_members(archive_path, accept):
+    """Read members of archive sequentially, without extraction.
+
+    Args:
+        archive_path: File name of ZIP or TAR archive.
+        accept: Function called with member name, returns True
+            if the member should be read.
+
+    Returns generator of tuples (member_name, data).
+
+    Raises:
+        IOError: Archive could not be read.
+
+    """
+    import tarfile
+    import zipfile
+    try:
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir() and accept(info.filename):
+                        yield info.filename, zf.read(info)
+            return
+        # Stream mode: members are read in order, no seeking
+        with tarfile.open(archive_path, 'r|*') as tf:
+            for info in tf:
+                if info.isfile() and accept(info.name):
+                    yield info.name, tf.extractfile(info).read()
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        raise IOError('Could not read archive %r: %s' % (archive_path, e))
+
+
+def read_member(filename):
+    """Read content of archive member referenced by `filename`.
+
+    Archives are kept open between calls (see :func:`_open_archive`),
+    so reading more members of one archive doesn't scan it again.
+
+    Raises:
+        IOError: Archive or its member could not be read.
+
+    """
+    import tarfile
+    import zipfile
+    archive_path, member_name = split_member_name(filename)
+    if member_name is None:
+        raise IOError('Not an archive member: %r' % filename)
+    with _open_lock:
+        try:
+            opened = _open_archive(archive_path)
+            if isinstance(opened, zipfile.ZipFile):
+                return opened.read(member_name)
+            f = opened.extractfile(member_name)
+            if f is None:
+                raise IOError('Not a regular file: %r' % filename)
+            return f.read()
+        except KeyError:
+            raise IOError('Archive member not found: %r' % filename)
+        except (tarfile.TarError, zipfile.BadZipFile) as e:
+            _close_archive(archive_path)
+            raise IOError('Could not read archive %r: %s' % (archive_path, e))
+
+
+# Number of archives kept open by read_member
+MAX_OPEN_ARCHIVES = 4
+
+# Archive path -> (version of the file, ZipFile or TarFile), in LRU order
+_open_archives = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def _open_archive(archive_path):
+    """Return open ZipFile or TarFile of `archive_path`.
+
+    Reopened when the file has changed. Member index of TarFile is built
+    on first lookup, by scanning the archive once.
+
+    """
+    import tarfile
+    import zipfile
+    st = os.stat(archive_path)
+    version = st.st_ino, st.st_mtime_ns, st.st_size
+    cached = _open_archives.get(archive_path)
+    if cached is not None:
+        if cached[0] == version:
+            _open_archives.move_to_end(archive_path)
+            return cached[1]
+        _close_archive(archive_path)
+    if zipfile.is_zipfile(archive_path):
+        opened = zipfile.ZipFile(archive_path)
+    else:
+        opened = tarfile.open(archive_path)
+    _open_archives[archive_path] = version, opened
+    while len(_open_archives) > MAX_OPEN_ARCHIVES:
+        _close_archive(next(iter(_open_archives)))
+    return opened
+
+
+def _close_archive(archive_path):
+    cached = _open_archives.pop(archive_path, None)
+    if cached is not None:
+        cached[1].close()
@@ -0,0 +1,95 @@
+import heapq
+import math
+from bisect import bisect_right
+
+
+class AspectIndex:
+
+    """Candidate pairs of images with similar aspect ratio.
+
+    Near-duplicates almost always share the aspect ratio, so there is
+    no need to compare hashes of images with different shapes.
+
+    Items are put into buckets by logarithm of their aspect ratio
+    (width / height of stored pixels, which are hashed). Buckets are
+    `log(1 + tolerance)` wide, so images with ratios differing by up to
+    `tolerance` are always in the same or adjacent buckets. Each bucket
+    is compared with itself and its neighbours, i.e. the buckets overlap.
+
+    With `rotated`, each item is also put into the bucket of its inverted
+    ratio, so images rotated by 90 degrees are compared too.
+
+    Items with unknown dimensions are compared with all items.
+
+    """
+
+    def __init__(self, tolerance, rotated=False):
+        if tolerance <= 0:
+            raise ValueError('Aspect ratio tolerance must be positive')
+        self.tolerance = tolerance
+        self.rotated = rotated
+        self._bucket_width = math.log1p(tolerance)
+
+    def buckets(self, item):
+        """Return set of buckets of `item`, None if dimensions are unknown."""
+        if not item.width or not item.height:
+            return None
+        ratio = math.log(item.width / item.height)
+        buckets = {math.floor(ratio / self._bucket_width)}
+        if self.rotated:
+            buckets.add(math.floor(-ratio / self._bucket_width))
+        return buckets
+
+    def candidate_pairs(self, entries):
+        """Generate candidate pairs from `entries`, list of (item, hash)
+        as returned by :meth:`dedupimages.hashdb.HashDB.hashed_items`.
+
+        Pairs of entries come in the same order
+        as from :func:`itertools.combinations`.
+
+        """
+        # Bucket -> positions of entries, sorted
+        members = {}
+        unknown = []
+        entry_buckets = []
+        for pos, (item, _imghash) in enumerate(entries):
+            buckets = self.buckets(item)
+            entry_buckets.append(buckets)
+            if buckets is None:
+                unknown.append(pos)
+                continue
+            for bucket in buckets:
+                members.setdefault(bucket, []).append(pos)
+        for pos_a, buckets in enumerate(entry_buckets):
+            if buckets is None:
+                partners = range(pos_a + 1, len(entries))
+            else:
+                neighbours = {neighbour for bucket in buckets
+                              for neighbour in (bucket - 1, bucket, bucket + 1)}
+                sources = [unknown]
+                sources.extend(members[neighbour] for neighbour in neighbours
+                               if neighbour in members)
+                partners = self._merge_after(pos_a, sources)
+            entry_a = entries[pos_a]
+            for entry_b in map(entries.__getitem__, partners):
+                yield entry_a, entry_b
+
+    @staticmethod
+    def _merge_after(pos, sources):
+        """Generate positions greater than `pos` from sorted lists `sources`,
+        in ascending order and without repetition."""
+        tails = []
+        for positions in sources:
+            start = bisect_right(positions, pos)
+            if start < len(positions):
+                tails.append(map(positions.__getitem__,
+                                 range(start, len(positions))))
+        if len(tails) == 1:
+            # Common case: one bucket, no duplicates
+            yield from tails[0]
+            return
+        last = pos
+        for pos_b in heapq.merge(*tails):
+            if pos_b != last:
+                last = pos_b
+                yield pos_b
@@ -0,0 +1,230 @@
+import array
+import heapq
+import os
+import tempfile
+import time
+
+from dedupimages.hashdb import HashDB
+from dedupimages.imagehash import ImageHash
+from dedupimages.stats import stats
+
+
+# Estimated memory of one hash in a tile (object and its value),
+# in addition to length of the hex string
+HASH_OBJECT_BYTES = 120
+
+# Estimated memory of one buffered edge, including sorting
+EDGE_BYTES = 64
+
+# Number of runs merged at once (open files)
+MAX_MERGE_RUNS = 64
+
+# Number of edges read from each run at once
+CHUNK_EDGES = 4096
+
+_POS_BITS = 32
+_POS_MASK = (1 << _POS_BITS) - 1
+
+
+class BlockedSearch:
+
+    """Search for all pairs of similar hashes with bounded memory.
+
+    Items are added by :meth:`add` with file name and hash, which are written
+    to temporary files. Only offsets of the records are kept in memory
+    (16 bytes per item).
+
+    The search goes through tiles of items, sized so that two tiles of
+    loaded hashes take half of `max_memory`. Similar pairs (edges) are
+    buffered in another quarter, then sorted and spilled to temporary files
+    as runs. The runs are merged to obtain edges in the same order as from
+    :meth:`dedupimages.hashdb.HashDB.find_pairs`, which are then grouped.
+
+    Use as context manager, the temporary files are removed on exit.
+
+    """
+
+    def __init__(self, hash_name, max_memory, tmpdir=None):
+        self.imagehash_class = ImageHash.get_subclass(hash_name)
+        self.max_memory = max_memory
+        self._dir = tempfile.TemporaryDirectory(prefix='dedup-images-',
+                                                dir=tmpdir)
+        self._names = open(self._path('names'), 'w+b')
+        self._hashes = open(self._path('hashes'), 'w+b')
+        self._name_offsets = array.array('Q', [0])
+        self._hash_offsets = array.array('Q', [0])
+        # List of (name, number of edges)
+        self._runs = []
+        self._run_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._names.close()
+        self._hashes.close()
+        self._dir.cleanup()
+
+    def __len__(self):
+        return len(self._name_offsets) - 1
+
+    def _path(self, name):
+        return os.path.join(self._dir.name, name)
+
+    def add(self, fname, hexhash):
+        """Add item with file name `fname` and hash `hexhash`
+        (as saved in database)."""
+        self._names.write(fname.encode('utf8', 'surrogateescape'))
+        self._name_offsets.append(self._names.tell())
+        self._hashes.write(hexhash.encode('ascii'))
+        self._hash_offsets.append(self._hashes.tell())
+
+    def name(self, pos) -> str:
+        """Return file name of item at `pos`."""
+        offsets = self._name_offsets
+        self._names.seek(offsets[pos])
+        data = self._names.read(offsets[pos + 1] - offsets[pos])
+        return data.decode('utf8', 'surrogateescape')
+
+    def _read_tile(self, lo, hi) -> list:
+        """Load hashes of items at positions `lo` to `hi`."""
+        offsets = self._hash_offsets
+        self._hashes.seek(offsets[lo])
+        data = self._hashes.read(offsets[hi] - offsets[lo]).decode('ascii')
+        base = offsets[lo]
+        load = self.imagehash_class.load
+        return [load(data[offsets[pos] - base:offsets[pos + 1] - base])
+                for pos in range(lo, hi)]
+
+    def tile_size(self) -> int:
+        """Number of items in a tile."""
+        if not len(self):
+            return 1
+        hex_length = self._hash_offsets[-1] / len(self)
+        item_bytes = HASH_OBJECT_BYTES + hex_length
+        return max(1, int(self.max_memory / 4 / item_bytes))
+
+    def find_groups(self, threshold):
+        """Find groups of similar images.
+
+        Returns generator of (fname_a, [(fname_b, distance), ...]),
+        see :meth:`dedupimages.hashdb.HashDB.find_groups`.
+
+        """
+        self._find_edges(threshold)
+        edges = ((key >> _POS_BITS, key & _POS_MASK, distance)
+                 for key, distance in self._merge_runs())
+        for pos_a, group in HashDB.group_pairs(edges):
+            yield (self.name(pos_a),
+                   sorted((self.name(pos_b), distance)
+                          for pos_b, distance in group))
+
+    def _find_edges(self, threshold):
+        """Compare all pairs of items, spill similar pairs to runs."""
+        count = len(self)
+        tile = self.tile_size()
+        max_edges = max(1, int(self.max_memory / 4 / EDGE_BYTES))
+        keys = array.array('Q')
+        distances = array.array('d')
+        comparisons = 0
+        start = time.perf_counter()
+        for lo_a in range(0, count, tile):
+            hi_a = min(lo_a + tile, count)
+            tile_a = self._read_tile(lo_a, hi_a)
+            for lo_b in range(lo_a, count, tile):
+                hi_b = min(lo_b + tile, count)
+                if lo_b == lo_a:
+                    tile_b = tile_a
+                else:
+                    tile_b = self._read_tile(lo_b, hi_b)
+                for pos_a in range(lo_a, hi_a):
+                    hash_a = tile_a[pos_a - lo_a]
+                    first_b = max(lo_b, pos_a + 1)
+                    for pos_b in range(first_b, hi_b):
+                        distance = hash_a.distance(tile_b[pos_b - lo_b])
+                        if distance <= threshold:
+                            keys.append(pos_a << _POS_BITS | pos_b)
+                            distances.append(distance)
+                    comparisons += max(0, hi_b - first_b)
+                    if len(keys) >= max_edges:
+                        self._spill(keys, distances)
+                        keys = array.array('Q')
+                        distances = array.array('d')
+        if keys:
+            self._spill(keys, distances)
+        stats.add_time('compare', time.perf_counter() - start)
+        stats.count('comparisons', comparisons)
+        stats.count('spilled_runs', len(self._runs))
+
+    def _new_run(self):
+        self._run_count += 1
+        return 'run%d' % self._run_count
+
+    def _spill(self, keys, distances):
+        """Sort edges and write them as new run."""
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        name = self._new_run()
+        with open(self._path(name + '.keys'), 'wb') as f:
+            array.array('Q', (keys[n] for n in order)).tofile(f)
+        with open(self._path(name + '.dist'), 'wb') as f:
+            array.array('d', (distances[n] for n in order)).tofile(f)
+        self._runs.append((name, len(keys)))
+
+    def _read_run(self, run):
+        """Generate (key, distance) from `run`, the files are then removed."""
+        name, count = run
+        keys_path = self._path(name + '.keys')
+        dist_path = self._path(name + '.dist')
+        with open(keys_path, 'rb') as keys_f, open(dist_path, 'rb') as dist_f:
+            remaining = count
+            while remaining:
+                n = min(CHUNK_EDGES, remaining)
+                keys = array.array('Q')
+                distances = array.array('d')
+                keys.fromfile(keys_f, n)
+                distances.fromfile(dist_f, n)
+                yield from zip(keys, distances)
+                remaining -= n
+        os.remove(keys_path)
+        os.remove(dist_path)
+
+    def _merge_runs(self):
+        """Generate edges (key, distance) sorted by key from all runs.
+
+        When there are too many runs, they are first merged into fewer ones.
+
+        """
+        runs = self._runs
+        while len(runs) > MAX_MERGE_RUNS:
+            merged = []
+            for n in range(0, len(runs), MAX_MERGE_RUNS):
+                batch = runs[n:n + MAX_MERGE_RUNS]
+                if len(batch) == 1:
+                    merged.extend(batch)
+                    continue
+                name = self._new_run()
+                count = 0
+                with open(self._path(name + '.keys'), 'wb') as keys_f, \
+                        open(self._path(name + '.dist'), 'wb') as dist_f:
+                    keys = array.array('Q')
+                    distances = array.array('d')
+                    for key, distance in heapq.merge(
+                            *(self._read_run(run) for run in batch)):
+                        keys.append(key)
+                        distances.append(distance)
+                        if len(keys) == CHUNK_EDGES:
+                            keys.tofile(keys_f)
+                            distances.tofile(dist_f)
+                            count += len(keys)
+                            keys = array.array('Q')
+                            distances = array.array('d')
+                    keys.tofile(keys_f)
+                    distances.tofile(dist_f)
+                    count += len(keys)
+                merged.append((name, count))
+            runs = merged
+        self._runs = []
+        return heapq.merge(*(self._read_run(run) for run in runs))
@@ -11,6 +11,24 @@ class Config:
         self.threshold = 90.0
         self.viewer = 'xdg-open'
         self.dbpath = DEFAULT_DB_PATH
+        self.reduced_decode = False
+        self.isolate = False
+        self.hash_timeout = 60
+        self.max_decode_memory = None
+        self.min_image_size = 32
+        self.read_order = 'name'
+        self.readahead = None
+        self.max_reads = 2
+        self.thumb_hash = False
+        self.cascade = False
+        self.candidate_threshold = 80.0
+        self.lsh = False
+        self.lsh_recall = 0.95
+        self.incremental = False
+        self.max_memory = None
+        self.jobs = 1
+        self.aspect_tolerance = None
+        self.aspect_rotated = False
 
     def try_load(self, path=DEFAULT_CONF_PATH):
         path = os.path.expanduser(path)
@@ -0,0 +1,88 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+def file_version(path):
+    """Return version of file at `path`, None if it doesn't exist.
+
+    Files written by :func:`atomic_write` are replaced by new ones,
+    so the version (device, inode, modification time and size of the file)
+    changes with each write.
+
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """Open file to replace `path` atomically.
+
+    The content is written to temporary file in the same directory, which
+    replaces `path` when the block finishes without exception. Readers see
+    either the old or the new content, never partially written one.
+    A reader which has opened the old file can keep reading it.
+
+    Permissions of the replaced file are kept.
+
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp',
+                                    dir=dirname)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            permissions = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            permissions = 0o666 & ~_umask()
+        os.chmod(tmp_path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def locked(path, on_wait=None):
+    """Hold exclusive advisory lock of file `path` for the block.
+
+    The lock is taken on separate file with '.lock' suffix, because
+    `path` itself is replaced by :func:`atomic_write`. When the lock is held
+    by other process, `on_wait` is called and then it's waited for.
+
+    Uses `fcntl.flock`, without locking on systems which don't have it.
+    The lock is not reentrant, not even within one process.
+
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if on_wait is not None:
+                on_wait()
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,214 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+# Leading bytes of image formats supported by pHash (CImg)
+MAGIC = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'II*\x00', '.tif'),
+    (b'MM\x00*', '.tif'),
+    (b'BM', '.bmp'),
+]
+
+# Memory of one pixel decoded by PIL (RGB padded to 4 bytes)
+PIL_BYTES_PER_PIXEL = 4
+
+# TIFF tag NewSubfileType and its flag of reduced-resolution image
+TIFF_NEW_SUBFILE_TYPE = 254
+SUBFILE_REDUCED = 1
+
+# Temporary pixel files are written to RAM-backed directory when available
+TEMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def pil_image():
+    """Import PIL.Image, without limit of image size.
+
+    Pillow refuses to open images bigger than `Image.MAX_IMAGE_PIXELS`
+    (decompression bomb protection), which includes big panoramas.
+    Here, images are probed by header, memory of decoding is limited
+    by '--max-decode-memory' instead.
+
+    Raises:
+        ImportError: PIL is not available.
+
+    """
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+    return Image
+
+
+def open_reduced(fp, size):
+    """Open image and decode it at reduced scale.
+
+    JPEG images are decoded with DCT-domain scaling (Pillow `draft`),
+    multi-page TIFF images use the smallest pyramid level which is still
+    big enough. Other formats are decoded in full and then reduced
+    by integer factor.
+
+    Args:
+        fp: File name or file object.
+        size: Minimal width and height of decoded image. Images smaller
+            than this are returned in original size.
+
+    Returns:
+        Loaded PIL.Image in mode 'RGB' or 'L'.
+
+    Raises:
+        IOError: Image could not be loaded.
+
+    Requires PIL.
+
+    """
+    Image = pil_image()
+    with Image.open(fp) as source:
+        _seek_pyramid_level(source, size)
+        source.draft('RGB', (size, size))
+        source.load()
+        image = source
+        if image.mode.startswith('I;16'):
+            # Can't be reduced, 32-bit integer mode can
+            image = image.convert('I')
+        factor = min(image.width // size, image.height // size)
+        image = image.reduce(factor) if factor > 1 else image.copy()
+    if image.mode in ('I', 'F'):
+        image = _scale_to_8bit(image)
+    elif image.mode not in ('RGB', 'L'):
+        grayscale = image.mode in ('1', 'LA')
+        image = image.convert('L' if grayscale else 'RGB')
+    return image
+
+
+def reduced_dimensions(width, height, image_format, size):
+    """Estimate dimensions of image in :func:`open_reduced`.
+
+    Returns tuple ((width, height) as decoded by PIL, (width, height)
+    of the result). JPEG is decoded already scaled by 1/2, 1/4 or 1/8,
+    other formats in full (pyramid levels of TIFF are not considered).
+
+    """
+    scale = 1
+    if image_format == 'JPEG':
+        # As selected by Pillow draft()
+        fit = min(width // size, height // size)
+        while scale * 2 <= min(fit, 8):
+            scale *= 2
+    decoded = -(-width // scale), -(-height // scale)
+    factor = max(1, min(decoded[0] // size, decoded[1] // size))
+    return decoded, (-(-decoded[0] // factor), -(-decoded[1] // factor))
+
+
+def _scale_to_8bit(image):
+    """Convert image of mode 'I' or 'F' to 'L', stretching its range
+    of values to 0..255 (plain conversion would clip them)."""
+    low, high = image.getextrema()
+    scale = 255 / (high - low) if high > low else 0
+    return image.point(lambda v: (v - low) * scale).convert('L')
+
+
+def _seek_pyramid_level(image, size):
+    """Select smallest frame of multi-page image which is at least `size`.
+
+    Only frames which are reduced copies of the first one are considered,
+    see :func:`_is_reduced_copy`. Other multi-page images (scans, faxes)
+    stay on the first page, which is also hashed by the full decode.
+
+    """
+    if getattr(image, 'n_frames', 1) < 2 or image.format != 'TIFF':
+        return
+    width, height = image.size
+    best_frame, best_width = 0, width
+    for frame in range(1, image.n_frames):
+        image.seek(frame)
+        if (size <= image.width < best_width and image.height >= size and
+                _is_reduced_copy(image, width, height)):
+            best_frame, best_width = frame, image.width
+    image.seek(best_frame)
+
+
+def _is_reduced_copy(frame, width, height):
+    """Check if TIFF `frame` is reduced copy of page of `width` x `height`.
+
+    It is when marked as reduced-resolution image by NewSubfileType,
+    or when it has the same aspect ratio (within rounding of dimensions).
+
+    """
+    if frame.tag_v2.get(TIFF_NEW_SUBFILE_TYPE, 0) & SUBFILE_REDUCED:
+        return True
+    return (abs(frame.width * height - frame.height * width) <=
+            width + height)
+
+
+@contextmanager
+def pixels_file(image):
+    """Write decoded `image` into uncompressed temporary file.
+
+    pHash reads images only from files. BMP is loaded by CImg natively,
+    without external decoder and without any decompression.
+
+    Yields name of the temporary file, which is removed afterwards.
+
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bmp', dir=TEMP_DIR) as f:
+        image.save(f, 'BMP')
+        f.flush()
+        yield f.name
+
+
+def guess_suffix(data):
+    """Guess file name suffix of image from its leading bytes.
+
+    Returns suffix including the dot, or None if the format is unknown.
+
+    """
+    for magic, suffix in MAGIC:
+        if data[:len(magic)] == magic:
+            return suffix
+    return None
+
+
+@contextmanager
+def buffer_file(data):
+    """Expose encoded image `data` to pHash as temporary file.
+
+    The file is created in RAM-backed directory when available.
+    Its suffix is set according to detected format, as CImg selects
+    the decoder by file name suffix.
+
+    Yields name of the temporary file, which is removed afterwards.
+
+    Raises:
+        IOError: Image format was not recognized.
+
+    """
+    suffix = guess_suffix(data)
+    if suffix is None:
+        raise IOError('Unknown image format.')
+    with tempfile.NamedTemporaryFile(suffix=suffix, dir=TEMP_DIR) as f:
+        f.write(data)
+        f.flush()
+        yield f.name
+
+
+@contextmanager
+def suffixed_file(filename, suffix):
+    """Expose file `filename` to pHash under name with different `suffix`.
+
+    CImg selects the decoder by file name suffix, so a misnamed image
+    (e.g. PNG named '.jpg') fails to load. This makes temporary symbolic
+    link with correct suffix, the content is not copied.
+
+    Yields name of the link, which is removed afterwards.
+
+    """
+    link_dir = tempfile.mkdtemp(dir=TEMP_DIR)
+    link_name = os.path.join(link_dir, 'image' + suffix)
+    try:
+        os.symlink(os.path.abspath(filename), link_name)
+        yield link_name
+    finally:
+        if os.path.lexists(link_name):
+            os.unlink(link_name)
+        os.rmdir(link_dir)
@@ -1,13 +1,19 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from contextlib import contextmanager, nullcontext
 import os.path
 import sys
 import json
 import gzip
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 
-from dedupimages.imagehash import ImageHash, compute_hash
+from dedupimages.imagehash import (ImageHash, DctImageHash, ThumbDctImageHash,
+                                   MhImageHash)
+from dedupimages.imagehash import compute_hash
 from dedupimages.hashdb import HashDB
 from dedupimages.config import Config
+from dedupimages import archive, dbfile
+from dedupimages.probe import probe_image, suffix_mismatch
+from dedupimages.stats import stats, timed_call
+from dedupimages.progress import Progress
 
 
 class DedupImages:
@@ -21,6 +27,8 @@ class DedupImages:
     To compute hashes, use '--hash' command. Computed hashes are written
     to hash database in '~/.cache/dedup-images.hashdb' file.
     Use '-r' option for recursive search of images in subdirectories.
+    Images inside ZIP and TAR archives are hashed too, without extraction.
+    They are recorded as 'archive.zip!/member.jpg'.
 
     To compare hashes and search for duplicates, use '--search' command.
     This reads hash database, compares each hash with each other
@@ -33,9 +41,77 @@ class DedupImages:
     When the same file is found elsewhere by '--hash', it just adds the file
     name to this dead item, thus handling file renames.
 
+    On spinning disks and NFS, files can be read in order of their location
+    ('--read-order inode' or 'physical') and ahead of decoding
+    ('--readahead'), with limited concurrent reads from each device
+    ('--max-reads').
+
+    Before computing perceptual hash, image header is probed for dimensions
+    and real format. Files which are not images are not decoded, nor are
+    images smaller than '--min-size'.
+
+    With '--thumb-hash', only DCT hash of embedded EXIF thumbnail
+    is computed by '--hash'. '--search' then uses these hashes to find
+    candidates (with '--candidate-threshold') and computes the full hashes
+    only for images in candidate pairs.
+
+    '--cascade' works the same way with DCT hashes of full images.
+    Candidates are found using in-memory LSH index of the DCT hashes
+    (see '--lsh-recall'). Only images in candidate pairs are hashed
+    by '--algorithm' (usually 'mh' or 'radial'), which then confirms
+    the pairs. This gives groups of the slower algorithm at cost close
+    to the DCT.
+
+    With '--lsh', search with 'mh' algorithm uses locality-sensitive hashing
+    index instead of comparing each hash with each other. This is much faster
+    for big databases, but a small part of similar pairs may be missed
+    (see '--lsh-recall'). The index is stored next to the hash database
+    (with '.lsh' suffix) and updated by '--hash'.
+
+    With '--incremental', pairs of similar images found by '--search'
+    are stored next to the hash database (one file per algorithm).
+    Following searches compare only images added or hashed again since then.
+    Stored pairs answer any threshold up to the one used to find them,
+    a looser threshold makes the search start over.
+
+    With '--max-memory', '--search' reads the database item by item
+    instead of loading it, and compares the hashes in blocks which fit
+    into the given memory. Similar pairs are collected in temporary files.
+    This allows searching databases bigger than memory. It's not used with
+    '--thumb-hash', '--cascade', '--lsh', '--incremental' and '--file'.
+
+    With '--aspect-tolerance PERCENT', '--search' compares only images
+    with similar aspect ratio (of dimensions read by '--hash').
+    '--aspect-rotated' also compares images rotated by 90 degrees.
+    This is not combined with '--lsh' or '--incremental'.
+
+    With '--jobs N', '--search' compares the hashes in N processes.
+    The hashes are packed into shared memory, which all processes read.
+    This doesn't apply with an index ('--lsh', '--incremental').
+
+    With '--against PATH' or '--against-db HASHDB', '--search' compares
+    images in 'path' (the query) only with reference images in PATH
+    or in another database, and reports matches for each query image.
+    Reference images are not compared with each other, query images only
+    with '--query-pairs'. Hashes of '--algorithm' are compared, the LSH
+    index is used with '--lsh' (also that of the other database).
+
+    Files which could not be hashed (load failure, timeout, crash of pHash)
+    are recorded in database as unhashable and skipped by later runs.
+    Use '--retry-unhashable' to try them again.
+
+    Timeout and crashes are handled only with '--isolate' (implied by
+    '--timeout'). By default, images are hashed in threads, which can't be
+    stopped: a decode which hangs blocks the run.
+
     Use '--prune' command to remove any items without file references
     from database. This is not needed unless the database grows too much.
 
+    The database may be used by more processes at once. Commands which
+    modify it wait for each other (by lock of file with '.lock' suffix),
+    '--search' alone doesn't wait, it works with the version it has loaded.
+    Files are replaced atomically, so readers never see partial content.
+
     Order of command execution is fixed (not affected by order of arguments):
 
     1. remove
@@ -56,7 +132,37 @@ class DedupImages:
         self.threshold = cfg.threshold
         self.viewer = cfg.viewer
         self.dbpath = cfg.dbpath
+        self.reduced_decode = cfg.reduced_decode
+        self.isolate = cfg.isolate
+        self.hash_timeout = cfg.hash_timeout
+        self.max_decode_memory = cfg.max_decode_memory
+        self.min_image_size = cfg.min_image_size
+        self.read_order = cfg.read_order
+        self.readahead = cfg.readahead
+        self.max_reads = cfg.max_reads
+        self.thumb_hash = cfg.thumb_hash
+        self.cascade = cfg.cascade
+        self.candidate_threshold = cfg.candidate_threshold
+        self.lsh = cfg.lsh
+        self.lsh_recall = cfg.lsh_recall
+        self.lsh_index = None
+        self.incremental = cfg.incremental
+        self.similarity_graph = None
+        self.max_memory = cfg.max_memory
+        self.jobs = cfg.jobs
+        self.aspect_tolerance = cfg.aspect_tolerance
+        self.aspect_rotated = cfg.aspect_rotated
+        self.against = None
+        self.against_db = None
+        self.query_pairs = False
+        self.retry_unhashable = False
+        self.output_format = 'text'
+        self.verbose = False
+        self.quiet = False
         self.hashdb = HashDB()
+        # Version of loaded database file, see dbfile.file_version
+        self.db_version = None
+        self.db_locked = False
 
     def process_args(self):
         # Process program args
@@ -80,11 +186,93 @@ class DedupImages:
         ap.add_argument('-t', '--threshold', type=float, default=self.threshold,
                         help='Minimal similarity ratio for image comparison. '
                              'Default: %(default)s%%')
+        ap.add_argument('--thumb-hash', action='store_true',
+                        default=self.thumb_hash,
+                        help='Hash embedded EXIF thumbnails, compute full '
+                             'hashes only for candidates found by search')
+        ap.add_argument('--cascade', action='store_true',
+                        default=self.cascade,
+                        help='Hash with dct, compute hashes of --algorithm '
+                             'only for candidates found by search')
+        ap.add_argument('--candidate-threshold', type=float,
+                        default=self.candidate_threshold,
+                        help='Minimal similarity ratio of candidates '
+                             'for --thumb-hash and --cascade. '
+                             'Default: %(default)s%%')
+        ap.add_argument('--lsh', action='store_true', default=self.lsh,
+                        help='Use locality-sensitive hashing index for '
+                             'search with mh algorithm')
+        ap.add_argument('--lsh-recall', type=float, default=self.lsh_recall,
+                        help='Probability of finding a similar pair '
+                             'by --lsh. Default: %(default)s')
+        ap.add_argument('--incremental', action='store_true',
+                        default=self.incremental,
+                        help='Store similar pairs, search only new '
+                             'or changed images next time')
+        ap.add_argument('--max-memory', metavar='SIZE',
+                        default=self.max_memory,
+                        help='Search in blocks with limited memory, '
+                             'e.g. 512M (database is not loaded)')
+        ap.add_argument('--aspect-tolerance', metavar='PERCENT', type=float,
+                        default=self.aspect_tolerance,
+                        help='Compare only images with aspect ratio '
+                             'differing by up to PERCENT, e.g. 5')
+        ap.add_argument('--aspect-rotated', action='store_true',
+                        default=self.aspect_rotated,
+                        help='With --aspect-tolerance, compare also images '
+                             'rotated by 90 degrees')
+        ap.add_argument('-j', '--jobs', metavar='N', type=int,
+                        default=self.jobs,
+                        help='Number of processes comparing hashes '
+                             'in search. Default: %(default)s')
         ap.add_argument('-F', '--fast', action='store_true',
                         help='Faster check for file modification '
                              '(Compare first 512 bytes only)')
+        ap.add_argument('--reduced-decode', action='store_true',
+                        default=self.reduced_decode,
+                        help='Decode images at reduced scale before computing '
+                             'perceptual hash (faster, requires PIL)')
+        ap.add_argument('--isolate', action='store_true', default=self.isolate,
+                        help='Compute perceptual hashes in worker processes, '
+                             'which are killed on timeout and survive crashes')
+        ap.add_argument('--timeout', type=float,
+                        help='Time limit for hashing one image '
+                             'in worker process, implies --isolate. '
+                             'Default: %s s' % self.hash_timeout)
+        ap.add_argument('--max-decode-memory', metavar='SIZE',
+                        default=self.max_decode_memory,
+                        help='Limit memory for images being decoded '
+                             'at the same time, e.g. 4G (requires PIL)')
+        ap.add_argument('--read-order', default=self.read_order,
+                        choices=('name', 'inode', 'physical'),
+                        help='Order of reading files in each directory: '
+                             'by name, inode number or physical location '
+                             '(Linux FIEMAP). Default: %(default)s')
+        ap.add_argument('--readahead', metavar='SIZE',
+                        default=self.readahead,
+                        help='Read files ahead in background, '
+                             'using up to SIZE of memory, e.g. 256M')
+        ap.add_argument('--max-reads', metavar='N', type=int,
+                        default=self.max_reads,
+                        help='Concurrent reads from one device '
+                             'for --readahead. Default: %(default)s')
+        ap.add_argument('--min-size', metavar='PIXELS', type=int,
+                        default=self.min_image_size,
+                        help='Do not hash images with width or height '
+                             'smaller than this. Default: %(default)s')
+        ap.add_argument('--retry-unhashable', action='store_true',
+                        help='Try again files which failed to hash before')
         ap.add_argument('-f', '--file',
                         help='Search for duplicates of this file')
+        ap.add_argument('--against', metavar='PATH',
+                        help='Compare images in `path` only with reference '
+                             'images in PATH')
+        ap.add_argument('--against-db', metavar='HASHDB',
+                        help='Compare images in `path` only with reference '
+                             'images in another hash database')
+        ap.add_argument('--query-pairs', action='store_true',
+                        help='With --against, compare images in `path` '
+                             'also with each other')
         ap.add_argument('-r', '--recursive', action='store_true',
                         help='Recursively traverse into subdirectories')
         ap.add_argument('-x', '--view', action='store_true',
@@ -93,33 +281,108 @@ class DedupImages:
                         help='Do not report binary equal sets')
         ap.add_argument('--db', metavar="HASHDB", default=self.dbpath,
                         help='Hash database. Default: %(default)s')
+        ap.add_argument('--format', choices=['text', 'jsonl'], default='text',
+                        help='Output format of search results. '
+                             'jsonl: one JSON record per group / match, '
+                             'other messages go to stderr. '
+                             'Default: %(default)s')
+        ap.add_argument('-v', '--verbose', action='store_true',
+                        help='Print each computed hash and updated directory')
+        ap.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not show progress')
+        ap.add_argument('--stats', action='store_true',
+                        help='Print time spent in each phase, counters '
+                             'and slowest files')
+        ap.add_argument('--stats-json', metavar='FILE',
+                        help='Write the statistics to FILE as JSON')
         return ap.parse_args()
 
     def main(self):
         args = self.process_args()
         self.algorithm = args.algorithm
         self.threshold = args.threshold
+        self.reduced_decode = args.reduced_decode
+        self.isolate = args.isolate
+        if args.timeout is not None:
+            # Only worker processes can be stopped on timeout
+            self.isolate = True
+            self.hash_timeout = args.timeout
+        self.min_image_size = args.min_size
+        self.read_order = args.read_order
+        self.readahead = args.readahead
+        if isinstance(self.readahead, str):
+            from dedupimages.scheduler import parse_size
+            self.readahead = parse_size(self.readahead)
+        self.max_reads = args.max_reads
+        self.thumb_hash = args.thumb_hash
+        self.cascade = args.cascade
+        self.candidate_threshold = args.candidate_threshold
+        self.lsh = args.lsh
+        self.lsh_recall = args.lsh_recall
+        self.incremental = args.incremental
+        self.max_decode_memory = args.max_decode_memory
+        if isinstance(self.max_decode_memory, str):
+            from dedupimages.scheduler import parse_size
+            self.max_decode_memory = parse_size(self.max_decode_memory)
+        self.max_memory = args.max_memory
+        if isinstance(self.max_memory, str):
+            from dedupimages.scheduler import parse_size
+            self.max_memory = parse_size(self.max_memory)
+        self.jobs = args.jobs
+        self.aspect_tolerance = args.aspect_tolerance
+        self.aspect_rotated = args.aspect_rotated
+        self.against = os.path.realpath(os.path.expanduser(args.against)) \
+            if args.against else None
+        self.against_db = os.path.expanduser(args.against_db) \
+            if args.against_db else None
+        self.query_pairs = args.query_pairs
+        self.retry_unhashable = args.retry_unhashable
+        self.output_format = args.format
+        self.verbose = args.verbose
+        self.quiet = args.quiet
         self.dbpath = os.path.expanduser(args.db)
         path = os.path.realpath(os.path.expanduser(args.path)) \
             if args.path else None
+        try:
+            self.run_commands(args, path)
+        finally:
+            if args.stats:
+                print(stats.summary(), file=sys.stderr)
+            if args.stats_json:
+                with open(args.stats_json, 'w') as f:
+                    json.dump(stats.as_dict(), f, indent='\t')
+
+    def run_commands(self, args, path):
         cmd_specified = (args.hash or args.search or args.remove or
                          args.cleanup or args.prune)
-        self.load_database(must_exist=cmd_specified and not args.hash)
-        # Execute commands
-        if args.remove:
-            self.cmd_remove(path, args.recursive)
-        if args.hash:
-            self.cmd_hash(path, args.recursive, args.fast)
-        if args.cleanup:
-            self.cmd_cleanup(path, args.fast)
-        if args.prune:
-            self.cmd_prune()
-        if args.search:
-            self.cmd_search(path, args.file, args.skip_bin, args.view)
-        if not cmd_specified:
-            self.cmd_hash(path, args.recursive, args.fast)
-            self.cmd_cleanup(path, args.fast)
-            self.cmd_search(path, args.file, args.skip_bin, args.view)
+        # Perceptual hashes are not needed for remove, cleanup and prune
+        algorithms = set()
+        if args.hash or args.search or not cmd_specified:
+            algorithms.update((self.algorithm, self.hash_algorithm))
+        search_only = args.search and not (args.hash or args.remove or
+                                           args.cleanup or args.prune)
+        # Writers take turns, search works with snapshot of the database
+        with nullcontext() if search_only else self.lock_database():
+            if not (search_only and args.file is None and
+                    self.use_blocked_search()):
+                # Blocked search reads the database by itself
+                self.load_database(must_exist=cmd_specified and not args.hash,
+                                   algorithms=algorithms)
+            # Execute commands
+            if args.remove:
+                self.cmd_remove(path, args.recursive)
+            if args.hash:
+                self.cmd_hash(path, args.recursive, args.fast)
+            if args.cleanup:
+                self.cmd_cleanup(path, args.fast)
+            if args.prune:
+                self.cmd_prune()
+            if args.search:
+                self.cmd_search(path, args.file, args.skip_bin, args.view)
+            if not cmd_specified:
+                self.cmd_hash(path, args.recursive, args.fast)
+                self.cmd_cleanup(path, args.fast)
+                self.cmd_search(path, args.file, args.skip_bin, args.view)
 
     def cmd_hash(self, path, recursive, fast_compare=False):
         """Walk through `path` and add or update image hashes in database"""
@@ -128,55 +391,92 @@ class DedupImages:
         else:
             paths_to_hash = [p for p in self.hashdb.list_top_paths()
                              if os.path.exists(p)]
+        progress = Progress('Hashing', enabled=not self.quiet)
         try:
-            for path in paths_to_hash:
-                for dirpath, filenames in self.list_directories(path, recursive):
-                    self.update_db(dirpath, filenames, fast_compare)
+            with stats.phase('hash'):
+                # Walk first, so that the total (and ETA) is known
+                directories = [
+                    entry for path in paths_to_hash
+                    for entry in stats.timed_iter(
+                        'walk', self.list_directories(path, recursive))]
+                # Archive members are added to the total when found
+                progress.set_total(sum(
+                    not archive.is_archive(fname)
+                    for _dirpath, filenames in directories
+                    for fname in filenames))
+                for dirpath, filenames in directories:
+                    self.update_db(dirpath, filenames, fast_compare, progress)
         finally:
+            progress.finish()
             self.save_database()
+        if self.use_lsh():
+            self.update_lsh_index()
 
     def cmd_search(self, path, sample_file=None, skip_bin=False, view=False):
         """Search database for similar images in `path`"""
         # If path was specified, search for duplicates only in path
         # Otherwise, all hashed images in database are searched
+        if sample_file is None and self.use_blocked_search():
+            try:
+                with stats.phase('search'):
+                    self.search_blocked(path, skip_bin, view)
+            except StopIteration:
+                pass
+            return
+        hashdb = self.hashdb
+        self.lsh_index = self.update_lsh_index() if self.use_lsh() else None
+        if sample_file is None and (self.against or self.against_db):
+            try:
+                with stats.phase('search'):
+                    self.search_against(path, view)
+            except StopIteration:
+                pass
+            return
+        self.similarity_graph = None
+        if self.incremental and self.prefilter_algorithm is None:
+            self.similarity_graph = self.update_graph()
         if path:
-            self.hashdb.filter_by_path(path)
-        print("Searching in %s files" % len(self.hashdb.items))
+            self.hashdb = hashdb.filtered_by_path(path)
+        self.info("Searching in %s files" % len(self.hashdb.items))
+        try:
+            with stats.phase('search'):
+                self.search(sample_file, skip_bin, view)
+        except StopIteration:
+            pass
+        finally:
+            self.hashdb = hashdb
+            if self.prefilter_algorithm:
+                # Keep full hashes computed for candidates
+                self.save_database()
+
+    def search(self, sample_file, skip_bin, view):
         # If sample file was specified, search for similar images
         # Otherwise, search whole database for groups of similar images
         if sample_file:
             self.compare_with_db(sample_file, view)
         else:
-            try:
-                if not skip_bin:
-                    self.show_binary_dupes(view)
-                self.search_db_for_dupes(view)
-            except StopIteration:
-                pass
+            if not skip_bin:
+                self.show_binary_dupes(view)
+            self.search_db_for_dupes(view)
 
     def cmd_remove(self, path, recursive):
         """Remove files in `path` from database"""
-        def in_path(filename):
-            if recursive:
-                return filename.startswith(path)
-            else:
-                return os.path.dirname(filename) == path
-        for item in self.hashdb.items:
-            filtered = {fn for fn in item.file_names if not in_path(fn)}
-            for removed_filename in item.file_names.difference(filtered):
-                print("Removing", removed_filename)
-            item.file_names = filtered
+        for removed_filename in self.hashdb.remove_path(path, recursive):
+            self.info("Removing", removed_filename)
         self.save_database()
 
     def cmd_cleanup(self, path=None, fast=False):
         """Check files in `path`, remove references
         to deleted or modified files from the database"""
-        print("Checking %s" % (path or 'database'))
-        for item in self.hashdb.items:
-            original_file_names = item.file_names
-            item.check_file_names(path=path, fast=fast)
-            for filename in original_file_names.difference(item.file_names):
-                print("Removing file reference", filename)
+        self.info("Checking %s" % (path or 'database'))
+        progress = Progress('Checking', unit='items', enabled=not self.quiet)
+        progress.set_total(len(self.hashdb.items_in_path(path)) if path
+                           else len(self.hashdb.items))
+        for _item, removed in self.hashdb.check_file_names(path, fast):
+            for filename in removed:
+                self.info("Removing file reference", filename)
+            progress.update()
+        progress.finish()
         self.save_database()
 
     def cmd_prune(self):
@@ -186,15 +486,23 @@ class DedupImages:
         self.hashdb.prune()
         pruned = original_items_len - len(self.hashdb.items)
         if pruned:
-            print("Pruned", pruned, "hashed files without any file names")
+            self.info("Pruned", pruned, "hashed files without any file names")
         self.save_database()
 
-    def load_database(self, must_exist=False):
+    def load_database(self, must_exist=False, algorithms=None):
+        """Load hash database from `self.dbpath`.
+
+        Only perceptual hashes of `algorithms` are loaded (all when None),
+        see :meth:`dedupimages.hashdb.HashItem.load`.
+
+        """
         try:
-            with gzip.open(self.dbpath, 'rt', encoding='utf8') as f:
-                dbitems = json.load(f)
-            self.hashdb = HashDB.load(dbitems)
-            print("Loaded database: %s files" % len(self.hashdb.items))
+            with stats.phase('db_load'):
+                # Taken before reading: if the file is replaced meanwhile,
+                # save_database merges instead of overwriting
+                self.db_version = dbfile.file_version(self.dbpath)
+                self.hashdb = self.read_database(self.dbpath, algorithms)
+            self.info("Loaded database: %s files" % len(self.hashdb.items))
         except IOError:
             if must_exist:
                 raise
@@ -202,21 +510,74 @@ class DedupImages:
                   "using new empty database..." % self.dbpath,
                   file=sys.stderr)
 
+    @staticmethod
+    def read_database(path, algorithms=None) -> HashDB:
+        """Read hash database from `path`, see :meth:`load_database`."""
+        with gzip.open(path, 'rt', encoding='utf8') as f:
+            dbitems = json.load(f)
+        return HashDB.load(dbitems, algorithms)
+
+    @contextmanager
+    def lock_database(self):
+        """Hold lock of the database for the block, unless already held.
+
+        Processes which modify the database hold the lock from loading
+        to the last save, so they don't lose updates of each other.
+        See :func:`dedupimages.dbfile.locked`.
+
+        """
+        if self.db_locked:
+            yield
+            return
+
+        def on_wait():
+            self.info("Waiting for other process to release %s" % self.dbpath)
+
+        with dbfile.locked(self.dbpath, on_wait):
+            self.db_locked = True
+            try:
+                yield
+            finally:
+                self.db_locked = False
+
     def save_database(self):
-        dbitems = self.hashdb.dump()
-        with gzip.open(self.dbpath, 'wt', encoding='utf8') as f:
-            json.dump(dbitems, f, indent='\t')
+        """Save hash database to `self.dbpath`.
+
+        The file is replaced atomically, readers (e.g. concurrent search)
+        see either the old or the new version.
+
+        Search saves hashes it computed (see '--cascade') without holding
+        the lock since loading. If the file was replaced by other process
+        meanwhile, the hashes are added to the new version instead.
+        If it no longer exists (or never did), the database is just written.
+
+        """
+        with self.lock_database(), stats.phase('db_save'):
+            hashdb = self.hashdb
+            version = dbfile.file_version(self.dbpath)
+            if version is not None and version != self.db_version:
+                current = self.read_database(self.dbpath)
+                updated = current.add_hashes_from(hashdb)
+                self.info("Database was changed by other process, "
+                          "adding hashes of %s items" % updated)
+                hashdb = self.hashdb = current
+            dbitems = hashdb.dump()
+            with dbfile.atomic_write(self.dbpath) as raw, \
+                    gzip.open(raw, 'wt', encoding='utf8') as f:
+                json.dump(dbitems, f, indent='\t')
+            self.db_version = dbfile.file_version(self.dbpath)
 
     def list_directories(self, path, recursive):
         if recursive:
             for dirpath, _dirnames, filenames in os.walk(path):
                 filenames = [fname for fname in filenames
-                             if self.is_image(fname)]
+                             if self.is_image(fname) or
+                             archive.is_archive(fname)]
                 filenames.sort()
                 yield dirpath, filenames
         else:
             filenames = [fname for fname in os.listdir(path)
-                         if self.is_image(fname)]
+                         if self.is_image(fname) or archive.is_archive(fname)]
             filenames.sort()
             yield path, filenames
 
@@ -225,25 +586,204 @@ class DedupImages:
         if ext.lower() in self.FORMATS:
             return True
 
-    def update_db(self, path, filenames, fast_compare):
-        print('Updating', path)
-        with PoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+    def list_files(self, path, filenames, fast_compare=False):
+        """Generate (filepath, data) for images in `filenames`.
+
+        Files are listed in '--read-order',
+        see :func:`dedupimages.ioschedule.order_reads`.
+
+        Images are read from archives in memory, `data` contains their content.
+        For regular files, `data` is None, unless they are read ahead
+        ('--readahead', see :func:`dedupimages.ioschedule.read_ahead`).
+        Read ahead data is used for fingerprint and '--reduced-decode',
+        otherwise pHash reads the file again, from page cache.
+        With `fast_compare`, files probably known already are not read ahead,
+        only their first bytes will be read.
+
+        """
+        from dedupimages.ioschedule import order_reads, read_ahead
+        filepaths = order_reads([os.path.join(path, fname)
+                                 for fname in filenames], self.read_order)
+        contents = None
+        if self.readahead:
+            to_read = [filepath for filepath in filepaths
+                       if not archive.is_archive(filepath) and
+                       not (fast_compare and self.probably_known(filepath))]
+            contents = read_ahead(to_read, self.readahead, self.max_reads)
+            to_read = set(to_read)
+        for filepath in filepaths:
+            if not archive.is_archive(filepath):
+                data = None
+                if contents is not None and filepath in to_read:
+                    _filepath, data = next(contents)
+                yield filepath, data
+                continue
+            try:
+                for member_name, data in archive.iter_members(filepath,
+                                                              self.is_image):
+                    yield filepath + archive.SEPARATOR + member_name, data
+            except IOError as e:
+                print(e, file=sys.stderr)
+
+    def probably_known(self, filepath):
+        """Check if `filepath` is in database with the same size."""
+        item = self.hashdb.find_item(filepath)
+        try:
+            return item is not None and \
+                item.file_size == os.path.getsize(filepath)
+        except OSError:
+            return False
+
+    @property
+    def prefilter_algorithm(self):
+        """Algorithm of hashes for finding candidates, None if not used."""
+        if self.thumb_hash:
+            return ThumbDctImageHash.algorithm()
+        if self.cascade:
+            return DctImageHash.algorithm()
+        return None
+
+    @property
+    def hash_algorithm(self):
+        """Algorithm of hashes computed by '--hash'."""
+        return self.prefilter_algorithm or self.algorithm
+
+    def update_db(self, path, filenames, fast_compare, progress=None):
+        # Not imported on start, these take a while
+        from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+        from concurrent.futures import wait, FIRST_COMPLETED
+        from dedupimages.workers import (IsolatedPool, WorkerCrashed,
+                                         WorkerTimeout)
+        from dedupimages.scheduler import DecodeScheduler
+        if self.verbose:
+            self.info('Updating', path)
+        if progress is None:
+            progress = Progress('Hashing', enabled=False)
+        max_workers = os.cpu_count() or 4
+        if self.isolate:
+            executor = IsolatedPool(max_workers, timeout=self.hash_timeout)
+        else:
+            # Threads can't be stopped, there is no timeout
+            executor = PoolExecutor(max_workers=max_workers)
+        with executor:
+            scheduler = DecodeScheduler(executor, self.max_decode_memory,
+                                        max_jobs=max_workers)
             # Compute hashes for new or updated files
             hashes = []
-            imagehash_class = ImageHash.get_subclass(self.algorithm)
-            for fname in filenames:
-                filepath = os.path.join(path, fname)
-                file_hash = self.hashdb.add(filepath, fast_compare=fast_compare)
-                if self.algorithm not in file_hash.image_hash:
-                    # Not seen before -> compute image hash
-                    future_imghash = executor.submit(compute_hash,
-                                                     imagehash_class,
-                                                     filepath)
-                    hashes.append((file_hash, future_imghash))
+            pending = set()
+            imagehash_class = ImageHash.get_subclass(self.hash_algorithm)
+            for filepath, data in self.list_files(path, filenames,
+                                                  fast_compare):
+                is_member = archive.split_member_name(filepath)[1] is not None
+                if is_member:
+                    # Archive members are counted when found
+                    progress.add_total(1)
+                file_hash = self.hashdb.add(filepath, fast_compare=fast_compare,
+                                            data=data)
+                if self.retry_unhashable:
+                    file_hash.unhashable.pop(self.hash_algorithm, None)
+                if (self.hash_algorithm in file_hash.image_hash or
+                        self.hash_algorithm in file_hash.unhashable):
+                    stats.count('cache_hits')
+                    progress.update()
+                    continue
+                if not (is_member or self.reduced_decode):
+                    # Regular file read ahead is now in page cache, pHash
+                    # opens it by name. Passing the data would copy it
+                    # to a temporary file (decode.buffer_file).
+                    data = None
+                # Not seen before -> probe header, compute image hash
+                try:
+                    suffix = self.probe(file_hash, filepath, data)
+                except IOError as e:
+                    self.mark_unhashable(file_hash, str(e))
+                    progress.update()
+                    continue
+                if self.too_small(file_hash):
+                    progress.update()
+                    continue
+                if len(pending) >= 2 * max_workers:
+                    # Limit archive members held in memory
+                    _done, pending = wait(pending,
+                                          return_when=FIRST_COMPLETED)
+                cost = self.decode_cost(imagehash_class, file_hash)
+                future_imghash = scheduler.submit(cost, timed_call,
+                                                  compute_hash,
+                                                  imagehash_class,
+                                                  filepath,
+                                                  self.reduced_decode,
+                                                  data, suffix)
+                hashes.append((file_hash, future_imghash))
+                pending.add(future_imghash)
             # Write results back into HashItem objects
             for file_hash, future_imghash in hashes:
-                imghash = future_imghash.result(timeout=60)
-                file_hash.image_hash[self.algorithm] = imghash
+                progress.update()
+                try:
+                    # Isolated pool enforces the timeout itself
+                    imghash, seconds = future_imghash.result()
+                except (IOError, WorkerCrashed, WorkerTimeout) as e:
+                    reason = str(e)
+                except Exception as e:
+                    # Unexpected failure of decoder, don't stop the run
+                    reason = '%s: %s' % (type(e).__name__, e)
+                else:
+                    file_hash.image_hash[self.hash_algorithm] = imghash
+                    filename = file_hash.canonical_name
+                    stats.file_hashed(filename, seconds)
+                    if self.verbose:
+                        self.info(imghash, filename)
+                    continue
+                self.mark_unhashable(file_hash, reason)
+
+    def probe(self, file_hash, filepath, data=None):
+        """Read image header, store image properties in `file_hash`.
+
+        Returns file suffix to be used by pHash when the file is misnamed,
+        otherwise None.
+
+        Raises IOError if the file is not a supported image.
+
+        """
+        if file_hash.image_format is None:
+            file_hash.set_image_info(probe_image(filepath, data))
+        if data is not None:
+            # Buffers are passed to pHash with suffix according to content
+            return None
+        return suffix_mismatch(filepath, file_hash.image_format)
+
+    def too_small(self, file_hash):
+        if file_hash.width is None:
+            return False
+        return min(file_hash.width, file_hash.height) < self.min_image_size
+
+    def mark_unhashable(self, file_hash, reason):
+        file_hash.unhashable[self.hash_algorithm] = reason
+        print("Unhashable: %s (%s)"
+              % (file_hash.canonical_name, reason),
+              file=sys.stderr)
+
+    def decode_cost(self, imagehash_class, file_hash):
+        """Estimate memory needed for computing image hash of `file_hash`.
+
+        Uses dimensions read from image header. Returns 0 when not limiting
+        decode memory or when the dimensions are not known.
+
+        With `reduced_decode`, the image decoded by PIL is counted,
+        and pHash works only with the reduced one,
+        see :func:`dedupimages.decode.reduced_dimensions`.
+
+        """
+        if not self.max_decode_memory or file_hash.width is None:
+            return 0
+        width, height = file_hash.width, file_hash.height
+        if not self.reduced_decode:
+            return width * height * imagehash_class.decode_bytes_per_pixel
+        from dedupimages.decode import PIL_BYTES_PER_PIXEL, reduced_dimensions
+        (decoded_w, decoded_h), (reduced_w, reduced_h) = reduced_dimensions(
+            width, height, file_hash.image_format,
+            imagehash_class.decode_size)
+        return (decoded_w * decoded_h * PIL_BYTES_PER_PIXEL +
+                reduced_w * reduced_h * imagehash_class.decode_bytes_per_pixel)
 
     def show_binary_dupes(self, gui=False):
         """View groups of files with same binary content.
@@ -254,14 +794,21 @@ class DedupImages:
         Raises StopIteration if quit was requested.
 
         """
-        items = (item for item in self.hashdb.items if len(item.file_names) > 1)
+        items = (item for item in self.hashdb.items if item.name_count > 1)
         for n, item in enumerate(items, start=1):
-            title = "Binary equal (set #%s)" % n
+            self.report_binary_dupes(n, list(item.file_names), gui)
+
+    def report_binary_dupes(self, n, file_names, gui=False):
+        title = "Binary equal (set #%s)" % n
+        if self.output_format == 'jsonl':
+            self.write_record({'type': 'binary', 'set': n,
+                               'files': sorted(file_names)})
+        else:
             print('--- %s ---' % title)
-            for fname in item.file_names:
+            for fname in file_names:
                 print(fname)
-            if gui:
-                self.view(title, list(item.file_names))
+        if gui:
+            self.view(title, file_names)
 
     def search_db_for_dupes(self, gui=False):
         """Find and view groups of perceptually similar images.
@@ -273,35 +820,402 @@ class DedupImages:
 
         """
         threshold = 1.0 - (self.threshold / 100)
-        groups = self.hashdb.find_groups(threshold, self.algorithm)
+        prefilter = self.prefilter_algorithm
+        if prefilter:
+            index = self.prefilter_index(prefilter) or self.aspect_index()
+            pairs = self.hashdb.find_pairs(self.candidate_distance(), prefilter,
+                                           index, self.jobs)
+            groups = (self.hashdb.name_group(*group) for group
+                      in self.hashdb.group_pairs(
+                          self.verify_pairs(pairs, threshold)))
+        else:
+            index = self.lsh_index
+            if self.similarity_graph is not None:
+                index = self.similarity_graph
+            if index is None:
+                index = self.aspect_index()
+            groups = self.hashdb.find_groups(threshold, self.algorithm, index,
+                                             self.jobs)
+        self.report_groups(groups, gui)
+
+    def report_groups(self, groups, gui=False):
+        """Print and optionally view `groups` of similar images,
+        as returned by :meth:`dedupimages.hashdb.HashDB.find_groups`."""
         for n, (fname_a, group) in enumerate(groups, start=1):
             title = "Perceptually similar (set #%s)" % n
-            print('--- %s ---' % title)
-            print(fname_a)
-            file_list = [fname_a]
-            for fname_b, distance in group:
-                self.print_out(fname_b, distance)
-                file_list.append(fname_b)
+            file_list = [fname_a] + [fname_b for fname_b, _distance in group]
+            if self.output_format == 'jsonl':
+                self.write_record({
+                    'type': 'similar', 'set': n, 'file': fname_a,
+                    'similar': [self.match_record(fname_b, distance)
+                                for fname_b, distance in group]})
+            else:
+                print('--- %s ---' % title)
+                print(fname_a)
+                for fname_b, distance in group:
+                    self.print_out(fname_b, distance)
             if gui:
                 self.view(title, file_list)
 
+    def search_blocked(self, path, skip_bin, gui=False):
+        """Search database for binary equal and perceptually similar images
+        with memory limited by '--max-memory'.
+
+        The database is read item by item, it's not loaded. Items are then
+        searched in blocks, see :class:`dedupimages.blocked.BlockedSearch`.
+        They are kept in database order, so with `path`, the groups may come
+        in different order than from :meth:`search_db_for_dupes`.
+
+        Raises StopIteration if quit was requested.
+
+        """
+        from dedupimages.blocked import BlockedSearch
+        from dedupimages.hashdb import iter_dumped_items
+        threshold = 1.0 - (self.threshold / 100)
+        hash_key = 'ph_' + self.algorithm
+        items = 0
+        binary_sets = 0
+        with BlockedSearch(self.algorithm, self.max_memory) as search:
+            with stats.phase('db_load'):
+                with gzip.open(self.dbpath, 'rt', encoding='utf8') as f:
+                    for d in iter_dumped_items(f):
+                        names = sorted(name for name in d['names']
+                                       if not path or name.startswith(path))
+                        if not names:
+                            continue
+                        items += 1
+                        if len(names) > 1 and not skip_bin:
+                            binary_sets += 1
+                            self.report_binary_dupes(binary_sets, names, gui)
+                        hexhash = d.get(hash_key)
+                        if hexhash and hexhash != 'None':
+                            search.add(names[0], hexhash)
+            self.info("Searching in %s files" % items)
+            self.report_groups(search.find_groups(threshold), gui)
+
+    def search_against(self, path, gui=False):
+        """Compare images in `path` (or all images) with reference images
+        in '--against' path or '--against-db' database.
+
+        Reference images are never compared with each other. Query images
+        are compared with each other only with '--query-pairs'.
+        When query and reference paths overlap, the images in the inner path
+        are only in the one set. Matches are reported for each query image.
+
+        Raises StopIteration if quit was requested.
+
+        """
+        threshold = 1.0 - (self.threshold / 100)
+        queries = self.hashdb.filtered_by_path(path or '')
+        if self.against_db:
+            with stats.phase('db_load'):
+                reference = self.read_database(self.against_db,
+                                               {self.algorithm})
+            reference_index = self.reference_lsh_index(reference)
+        else:
+            reference = self.hashdb.filtered_by_path(self.against)
+            if path and path.startswith(self.against):
+                reference.remove_path(path)
+            else:
+                queries.remove_path(self.against)
+            reference_index = self.lsh_index
+        query_entries = [(item.canonical_name, imghash)
+                         for item, imghash
+                         in queries.hashed_items(self.algorithm)]
+        self.info("Comparing %s images with %s reference images"
+                  % (len(query_entries),
+                     len(reference.hashed_items(self.algorithm))))
+        results = reference.query_all(query_entries, threshold,
+                                      self.algorithm, reference_index)
+        if self.query_pairs:
+            pair_results = queries.query_all(query_entries, threshold,
+                                             self.algorithm, self.lsh_index)
+            results = ((fname, matches + [(match, distance)
+                                          for match, distance in pair_matches
+                                          if match != fname])
+                       for (fname, matches), (_fname, pair_matches)
+                       in zip(results, pair_results))
+        found = 0
+        for fname, matches in results:
+            if not matches:
+                continue
+            found += 1
+            matches.sort(key=lambda match: (match[1], match[0]))
+            title = "Similar to reference (#%s)" % found
+            if self.output_format == 'jsonl':
+                for match, distance in matches:
+                    self.write_record(dict({'type': 'match', 'query': fname},
+                                           **self.match_record(match,
+                                                               distance)))
+            else:
+                print('--- %s ---' % title)
+                print(fname)
+                for match, distance in matches:
+                    self.print_out(match, distance)
+            if gui:
+                self.view(title, [fname] + [match for match, _d in matches])
+        self.info("Found %s of %s images" % (found, len(query_entries)))
+
+    def reference_lsh_index(self, reference):
+        """Load LSH index of '--against-db' database, if present.
+
+        Items of `reference` missing in the index are added in memory,
+        the index is not saved. Returns None if the index can't be used.
+
+        """
+        from dedupimages.lsh import LshIndex
+        if not self.use_lsh():
+            return None
+        threshold = 1.0 - (self.threshold / 100)
+        entries = reference.hashed_items(self.algorithm)
+        try:
+            # Same location as lsh_path of the database
+            index = LshIndex.load(self.against_db + '.lsh')
+        except IOError:
+            return None
+        if not index.fits(threshold, self.lsh_recall, len(entries)):
+            return None
+        for item, imghash in entries:
+            index.add(item.content_digest, bytes(imghash))
+        return index
+
     def compare_with_db(self, sample_file, gui=False):
         imagehash_class = ImageHash.get_subclass(self.algorithm)
         sample_hash = imagehash_class(sample_file)
-        print(sample_file)
+        if self.output_format == 'text':
+            print(sample_file)
         file_list = [sample_file]
         threshold = 1.0 - (self.threshold / 100)
-        for fname, distance in self.hashdb.query(sample_hash, threshold,
-                                                 self.algorithm):
-            self.print_out(fname, distance)
+        prefilter = self.prefilter_algorithm
+        if prefilter:
+            prefilter_hash = ImageHash.get_subclass(prefilter)(sample_file)
+            candidates = self.hashdb.query(prefilter_hash,
+                                           self.candidate_distance(), prefilter,
+                                           self.prefilter_index(prefilter))
+            results = self.verify_group(sample_hash, candidates, threshold)
+        else:
+            results = self.hashdb.query(sample_hash, threshold,
+                                        self.algorithm, self.lsh_index)
+        for fname, distance in results:
+            if self.output_format == 'jsonl':
+                self.write_record(dict({'type': 'match', 'query': sample_file},
+                                       **self.match_record(fname, distance)))
+            else:
+                self.print_out(fname, distance)
             file_list.append(fname)
         if gui:
             self.view("Perceptually similar", file_list)
 
+    def use_lsh(self):
+        return (self.lsh and self.prefilter_algorithm is None and
+                self.algorithm == MhImageHash.algorithm())
+
+    def use_blocked_search(self):
+        return (self.max_memory is not None and
+                not (self.against or self.against_db) and
+                self.prefilter_algorithm is None and
+                not self.use_lsh() and not self.incremental)
+
+    @property
+    def lsh_path(self):
+        return self.dbpath + '.lsh'
+
+    def update_lsh_index(self):
+        """Load LSH index, add items missing in it and save it.
+
+        The index is built again when it was tuned for different parameters,
+        or when most of its entries no longer refer to items in database.
+
+        Returns :class:`dedupimages.lsh.LshIndex`, or None if the index
+        can't be used with current threshold.
+
+        """
+        from dedupimages.lsh import LshIndex, digest_key
+        threshold = 1.0 - (self.threshold / 100)
+        with stats.phase('lsh_update'):
+            entries = self.hashdb.hashed_items(self.algorithm)
+            try:
+                index = LshIndex.load(self.lsh_path)
+            except IOError:
+                index = None
+            if (index is not None and
+                    index.fits(threshold, self.lsh_recall, len(entries))):
+                live_keys = {digest_key(item.content_digest)
+                             for item, _imghash in entries}
+                if index.stale_count(live_keys) > len(index) // 2:
+                    index = None
+            else:
+                index = None
+            if index is None:
+                try:
+                    index = LshIndex.create(threshold, self.lsh_recall,
+                                            len(entries))
+                except ValueError as e:
+                    print("LSH index not used:", e, file=sys.stderr)
+                    return None
+            for item, imghash in entries:
+                index.add(item.content_digest, bytes(imghash))
+            if index.modified:
+                index.save(self.lsh_path)
+        return index
+
+    @property
+    def graph_path(self):
+        return '%s.%s.graph' % (self.dbpath, self.algorithm)
+
+    def update_graph(self):
+        """Load similarity graph, compare new or changed items and save it.
+
+        Returns :class:`dedupimages.graph.SimilarityGraph`.
+
+        """
+        from dedupimages.graph import SimilarityGraph
+        threshold = 1.0 - (self.threshold / 100)
+        with stats.phase('graph_update'):
+            try:
+                graph = SimilarityGraph.load(self.graph_path)
+            except IOError:
+                graph = None
+            if graph is None or graph.max_distance < threshold:
+                graph = SimilarityGraph(threshold)
+            compared = graph.update(self.hashdb.hashed_items(self.algorithm),
+                                    self.lsh_index)
+            if graph.modified:
+                graph.save(self.graph_path)
+        if self.verbose:
+            self.info("Compared %s new or changed files" % compared)
+        return graph
+
+    def candidate_distance(self):
+        return 1.0 - (self.candidate_threshold / 100)
+
+    def aspect_index(self):
+        """Return :class:`dedupimages.aspect.AspectIndex` for
+        '--aspect-tolerance', or None."""
+        if self.aspect_tolerance is None:
+            return None
+        from dedupimages.aspect import AspectIndex
+        return AspectIndex(self.aspect_tolerance / 100, self.aspect_rotated)
+
+    def prefilter_index(self, algorithm):
+        """Build LSH index of candidate hashes of `algorithm` in memory.
+
+        The index is used with '--cascade' or '--lsh'. These hashes are
+        small and cheap to index, so the index is not stored.
+
+        Returns None if the index is not used.
+
+        """
+        if not (self.cascade or self.lsh):
+            return None
+        from dedupimages.lsh import LshIndex
+        entries = self.hashdb.hashed_items(algorithm)
+        try:
+            index = LshIndex.create(self.candidate_distance(), self.lsh_recall,
+                                    len(entries), hash_bytes=8)
+        except ValueError as e:
+            print("LSH index not used:", e, file=sys.stderr)
+            return None
+        for item, imghash in entries:
+            index.add(item.content_digest, bytes(imghash))
+        return index
+
+    def verify_pairs(self, pairs, threshold):
+        """Verify candidate `pairs` (id_a, id_b, distance)
+        using full hashes, see :meth:`verify_group`.
+
+        Returns generator of verified pairs, with distance of full hashes.
+
+        """
+        item_by_id = self.hashdb.item_by_id
+        for id_a, id_b, _candidate_distance in pairs:
+            hash_a = self.full_hash(item_by_id(id_a))
+            hash_b = self.full_hash(item_by_id(id_b))
+            if hash_a is None or hash_b is None:
+                continue
+            distance = hash_a.distance(hash_b)
+            if distance <= threshold:
+                yield id_a, id_b, distance
+
+    def verify_group(self, hash_a, group, threshold):
+        """Verify candidates from `group` against `hash_a` using full hashes.
+
+        Full hashes of `self.algorithm` are computed as needed.
+
+        Returns list of (fname_b, distance) with distance within `threshold`.
+
+        """
+        if hash_a is None:
+            return []
+        verified = []
+        for fname_b, _candidate_distance in group:
+            hash_b = self.full_hash(self.hashdb.find_item(fname_b))
+            if hash_b is None:
+                continue
+            distance = hash_a.distance(hash_b)
+            if distance <= threshold:
+                verified.append((fname_b, distance))
+        return verified
+
+    def full_hash(self, item):
+        """Get hash of `self.algorithm` for `item`.
+
+        Computes the hash if not available yet, reading the file
+        of its canonical name. Returns None if the image could not be hashed
+        (or `item` is None).
+
+        """
+        if item is None or self.algorithm in item.unhashable:
+            return None
+        if self.algorithm not in item.image_hash:
+            fname = item.canonical_name
+            imagehash_class = ImageHash.get_subclass(self.algorithm)
+            try:
+                data = None
+                if archive.split_member_name(fname)[1] is not None:
+                    data = archive.read_member(fname)
+                suffix = self.probe(item, fname, data)
+                imghash, seconds = timed_call(compute_hash, imagehash_class,
+                                              fname, self.reduced_decode,
+                                              data, suffix)
+                item.image_hash[self.algorithm] = imghash
+                stats.file_hashed(fname, seconds)
+            except IOError as e:
+                print("Could not hash %s (%s)" % (fname, e), file=sys.stderr)
+                return None
+        return item.image_hash[self.algorithm]
+
     def print_out(self, fname, distance):
         similarity = (1.0 - distance) * 100.0
         print(fname, '(%.0f%%)' % similarity)
 
+    @staticmethod
+    def match_record(fname, distance):
+        return {'file': fname, 'distance': round(distance, 4),
+                'similarity': round((1.0 - distance) * 100.0, 2)}
+
+    @staticmethod
+    def write_record(record):
+        """Write `record` as one line of JSON (--format jsonl).
+
+        Flushed immediately, so the consumer can process results
+        while the search is still running.
+
+        """
+        print(json.dumps(record), flush=True)
+
+    @property
+    def info_file(self):
+        """Stream for informational messages.
+
+        In jsonl format, stdout is reserved for the records.
+
+        """
+        return sys.stderr if self.output_format == 'jsonl' else sys.stdout
+
+    def info(self, *args):
+        print(*args, file=self.info_file)
+
     def view(self, title, file_list):
         """Display files from `file_list` using external program.
 
@@ -314,11 +1228,19 @@ class DedupImages:
         if not len(file_list):
             return
         title += " - dedup-images"
-        print('* Opening GUI...', end='')
-        sys.stdout.flush()
+        print('* Opening GUI...', end='', file=self.info_file, flush=True)
+        # Image properties probed by --hash, no need to read them again
+        image_info = {}
+        for fname in file_list:
+            item = self.hashdb.find_item(fname)
+            if item and item.width is not None:
+                image_info[fname] = (item.width, item.height,
+                                     item.image_format, item.image_mode,
+                                     item.file_size)
         try:
-            want_next = ViewHelper(title, file_list, self.viewer).main()
+            want_next = ViewHelper(title, file_list, self.viewer,
+                                   image_info).main()
             if not want_next:
                 raise StopIteration("Quit requested")
         finally:
-            print('\r' + ' ' * 30 + '\r', end='')
+            print('\r' + ' ' * 30 + '\r', end='', file=self.info_file)
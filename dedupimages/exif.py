@@ -0,0 +1,130 @@
+import struct
+
+
+# EXIF data is stored in APP1 segment, its size is limited to 64 KiB
+HEADER_SIZE = 64 * 1024 + 1024
+
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+TAG_ORIENTATION = 0x0112
+
+
+def read_exif(filename, data=None):
+    """Read EXIF block (TIFF structure) from JPEG file header.
+
+    Only the first few KB of the file are read.
+
+    Returns:
+        EXIF data as bytes or None if the file has no EXIF.
+
+    """
+    if data is None:
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read(HEADER_SIZE)
+        except IOError:
+            return None
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        marker, length = struct.unpack_from('>HH', data, pos)
+        if marker == 0xffda or marker & 0xff00 != 0xff00:
+            # Start of scan, no more headers
+            return None
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xffe1 and segment[:6] == b'Exif\x00\x00':
+            return bytes(segment[6:])
+        pos += 2 + length
+    return None
+
+
+def _read_ifd(tiff, offset, endian):
+    """Read IFD entries at `offset`.
+
+    Returns tuple ({tag: (type, count, value_or_offset)}, next_ifd_offset).
+
+    """
+    count, = struct.unpack_from(endian + 'H', tiff, offset)
+    entries = {}
+    for n in range(count):
+        tag, typ, cnt, value = struct.unpack_from(endian + 'HHII', tiff,
+                                                  offset + 2 + 12 * n)
+        if typ == 3 and cnt == 1:
+            # SHORT value is stored in first two bytes of the field
+            value, = struct.unpack_from(endian + 'H', tiff,
+                                        offset + 2 + 12 * n + 8)
+        entries[tag] = (typ, cnt, value)
+    next_offset, = struct.unpack_from(endian + 'I', tiff, offset + 2 + 12 * count)
+    return entries, next_offset
+
+
+def parse_ifds(tiff):
+    """Parse IFD0 and IFD1 from EXIF TIFF structure.
+
+    Returns tuple (endian, ifd0, ifd1), where ifds are dicts as returned
+    by :func:`_read_ifd`, ifd1 may be empty. Returns None for invalid data.
+
+    """
+    if tiff[:4] == b'II*\x00':
+        endian = '<'
+    elif tiff[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return None
+    try:
+        offset, = struct.unpack_from(endian + 'I', tiff, 4)
+        ifd0, next_offset = _read_ifd(tiff, offset, endian)
+        ifd1 = _read_ifd(tiff, next_offset, endian)[0] if next_offset else {}
+    except struct.error:
+        return None
+    return endian, ifd0, ifd1
+
+
+def read_orientation(filename, data=None):
+    """Read EXIF orientation of JPEG file.
+
+    Args:
+        filename: Name of JPEG file.
+        data: Content of the file (or its beginning), if already in memory.
+
+    Returns:
+        Orientation 1 to 8 (1 is normal, 5 to 8 have width and height
+        swapped on display) or None if the file has no orientation.
+
+    """
+    tiff = read_exif(filename, data)
+    parsed = tiff and parse_ifds(tiff)
+    if not parsed:
+        return None
+    _endian, ifd0, _ifd1 = parsed
+    entry = ifd0.get(TAG_ORIENTATION)
+    if entry is None or not 1 <= entry[2] <= 8:
+        return None
+    return entry[2]
+
+
+def read_thumbnail(filename, data=None):
+    """Read embedded EXIF thumbnail from JPEG file.
+
+    Args:
+        filename: Name of JPEG file.
+        data: Content of the file (or its beginning), if already in memory.
+
+    Returns:
+        Thumbnail JPEG as bytes or None if there is no thumbnail.
+
+    """
+    tiff = read_exif(filename, data)
+    parsed = tiff and parse_ifds(tiff)
+    if not parsed:
+        return None
+    _endian, _ifd0, ifd1 = parsed
+    if TAG_THUMBNAIL_OFFSET not in ifd1 or TAG_THUMBNAIL_LENGTH not in ifd1:
+        return None
+    offset = ifd1[TAG_THUMBNAIL_OFFSET][2]
+    length = ifd1[TAG_THUMBNAIL_LENGTH][2]
+    thumbnail = tiff[offset:offset + length]
+    if len(thumbnail) != length or thumbnail[:2] != b'\xff\xd8':
+        return None
+    return thumbnail
@@ -0,0 +1,129 @@
+from collections.abc import MutableSet
+
+
+class DirectoryTable:
+
+    """Interned directory names.
+
+    Each directory name is stored once and referred to by integer id.
+    The directory name includes the trailing separator, so that file name
+    is reconstructed exactly by concatenation with the base name.
+
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def intern(self, dirname) -> int:
+        """Return id of `dirname`, add it to the table if not present."""
+        dir_id = self._ids.get(dirname)
+        if dir_id is None:
+            # The same int object is referenced by all entries
+            dir_id = self._ids[dirname] = len(self._dirs)
+            self._dirs.append(dirname)
+        return dir_id
+
+    def find(self, dirname):
+        """Return id of `dirname` or None if not present."""
+        return self._ids.get(dirname)
+
+    def __getitem__(self, dir_id) -> str:
+        return self._dirs[dir_id]
+
+    def split(self, filename, add=True):
+        """Split `filename` to (dir_id, basename).
+
+        Returns None if the directory is not present and `add` is False.
+
+        """
+        pos = filename.rfind('/') + 1
+        basename = filename[pos:]
+        if add:
+            return self.intern(filename[:pos]), basename
+        dir_id = self._ids.get(filename[:pos])
+        if dir_id is None:
+            return None
+        return dir_id, basename
+
+
+# Shared by all HashItem objects
+directories = DirectoryTable()
+
+
+class FileNames(MutableSet):
+
+    """Set of file names, stored compactly.
+
+    Names are kept as flat tuple (dir_id, basename, dir_id, basename, ...)
+    referring to shared :data:`directories`. Most items have only one or two
+    names, so the linear search is faster and much smaller than hash set.
+
+    Behaves like `set` of strings.
+
+    """
+
+    __slots__ = ('_entries',)
+
+    def __init__(self, names=()):
+        entries = []
+        for name in names:
+            dir_id, basename = directories.split(name)
+            if not self._find(entries, dir_id, basename):
+                entries.extend((dir_id, basename))
+        self._entries = tuple(entries)
+
+    @staticmethod
+    def _find(entries, dir_id, basename):
+        for pos in range(0, len(entries), 2):
+            if entries[pos] == dir_id and entries[pos + 1] == basename:
+                return True
+        return False
+
+    def __contains__(self, name):
+        entry = directories.split(name, add=False)
+        return entry is not None and self._find(self._entries, *entry)
+
+    def __iter__(self):
+        entries = self._entries
+        for pos in range(0, len(entries), 2):
+            yield directories[entries[pos]] + entries[pos + 1]
+
+    def __len__(self):
+        return len(self._entries) // 2
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, sorted(self))
+
+    def __getstate__(self):
+        # Directory ids are valid only in this process
+        return list(self)
+
+    def __setstate__(self, names):
+        self.__init__(names)
+
+    @classmethod
+    def _from_iterable(cls, names):
+        # Result of set operations (a - b, a | b, ...)
+        return set(names)
+
+    def add(self, name):
+        dir_id, basename = directories.split(name)
+        if not self._find(self._entries, dir_id, basename):
+            self._entries += (dir_id, basename)
+
+    def discard(self, name):
+        entry = directories.split(name, add=False)
+        if entry is None:
+            return
+        entries = self._entries
+        for pos in range(0, len(entries), 2):
+            if (entries[pos], entries[pos + 1]) == entry:
+                self._entries = entries[:pos] + entries[pos + 2:]
+                return
+
+    def difference(self, other):
+        return set(self).difference(other)
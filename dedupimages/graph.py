@@ -0,0 +1,179 @@
+import array
+import json
+import sys
+import time
+import zlib
+
+from dedupimages.dbfile import atomic_write
+from dedupimages.lsh import digest_key
+from dedupimages.stats import stats
+
+
+MAGIC = b'dedup-images graph 1\n'
+
+
+def hash_checksum(imghash) -> int:
+    """Checksum of hash value, to detect items hashed again."""
+    return zlib.crc32(str(imghash).encode())
+
+
+class SimilarityGraph:
+
+    """Pairs of similar items found by previous searches.
+
+    Nodes are items, identified by content SHA-256 (see
+    :func:`dedupimages.lsh.digest_key`), along with checksum of their hash.
+    Edges connect items with hash distance up to `max_distance`.
+
+    :meth:`update` compares only items which were added or hashed again
+    since the last update, and drops items which are gone. The graph then
+    answers searches with any threshold up to `max_distance`,
+    see :meth:`candidate_pairs`.
+
+    One graph is kept for each hash algorithm.
+
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.modified = False
+        # Digest key -> hash checksum
+        self._nodes = {}
+        self._edges_a = array.array('Q')
+        self._edges_b = array.array('Q')
+        self._distances = array.array('d')
+
+    def __len__(self):
+        return len(self._distances)
+
+    def update(self, entries, index=None) -> int:
+        """Update graph to contain `entries`, list of (item, hash)
+        as returned by :meth:`dedupimages.hashdb.HashDB.hashed_items`.
+
+        New or changed entries are compared with all entries, or only with
+        candidates from `index` (:class:`dedupimages.lsh.LshIndex`).
+
+        Returns number of compared entries.
+
+        """
+        current = {}
+        for entry in entries:
+            current[digest_key(entry[0].content_digest)] = entry
+        checksums = {key: hash_checksum(imghash)
+                     for key, (_item, imghash) in current.items()}
+        gone = {key for key, checksum in self._nodes.items()
+                if checksums.get(key) != checksum}
+        if gone:
+            self._remove_nodes(gone)
+        new_keys = [key for key in current if key not in self._nodes]
+        if not new_keys:
+            return 0
+        comparisons = 0
+        start = time.perf_counter()
+        compared = set()
+        for key_a in new_keys:
+            hash_a = current[key_a][1]
+            if index is None:
+                candidates = current
+            else:
+                candidates = {index.keys[entry_id]
+                              for entry_id in index.candidates(bytes(hash_a))}
+            for key_b in candidates:
+                if key_b == key_a or key_b in compared:
+                    continue
+                entry_b = current.get(key_b)
+                if entry_b is None:
+                    continue
+                comparisons += 1
+                distance = hash_a.distance(entry_b[1])
+                if distance <= self.max_distance:
+                    self._edges_a.append(key_a)
+                    self._edges_b.append(key_b)
+                    self._distances.append(distance)
+            compared.add(key_a)
+            self._nodes[key_a] = checksums[key_a]
+        stats.add_time('compare', time.perf_counter() - start)
+        stats.count('comparisons', comparisons)
+        self.modified = True
+        return len(new_keys)
+
+    def _remove_nodes(self, keys):
+        """Remove nodes with digest `keys` and their edges."""
+        keep = [n for n, (key_a, key_b)
+                in enumerate(zip(self._edges_a, self._edges_b))
+                if key_a not in keys and key_b not in keys]
+        self._edges_a = array.array('Q', (self._edges_a[n] for n in keep))
+        self._edges_b = array.array('Q', (self._edges_b[n] for n in keep))
+        self._distances = array.array('d', (self._distances[n] for n in keep))
+        for key in keys:
+            del self._nodes[key]
+        self.modified = True
+
+    def candidate_pairs(self, entries):
+        """Generate pairs of `entries` connected by an edge.
+
+        Pairs of entries come in the same order
+        as from :func:`itertools.combinations`.
+
+        """
+        position = {digest_key(item.content_digest): pos
+                    for pos, (item, _imghash) in enumerate(entries)}
+        neighbors = {}
+        for key_a, key_b in zip(self._edges_a, self._edges_b):
+            pos_a = position.get(key_a)
+            pos_b = position.get(key_b)
+            if pos_a is None or pos_b is None:
+                continue
+            if pos_a > pos_b:
+                pos_a, pos_b = pos_b, pos_a
+            neighbors.setdefault(pos_a, []).append(pos_b)
+        for pos_a in sorted(neighbors):
+            for pos_b in sorted(neighbors[pos_a]):
+                yield entries[pos_a], entries[pos_b]
+
+    def save(self, path):
+        header = {
+            'max_distance': self.max_distance,
+            'nodes': len(self._nodes),
+            'edges': len(self._distances),
+            'byteorder': sys.byteorder,
+        }
+        with atomic_write(path) as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            array.array('Q', self._nodes.keys()).tofile(f)
+            array.array('I', self._nodes.values()).tofile(f)
+            self._edges_a.tofile(f)
+            self._edges_b.tofile(f)
+            self._distances.tofile(f)
+        self.modified = False
+
+    @classmethod
+    def load(cls, path) -> 'SimilarityGraph':
+        """Load graph saved by :meth:`save`.
+
+        Raises:
+            IOError: File doesn't exist or is not valid.
+
+        """
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise IOError('Not a similarity graph: %r' % path)
+            try:
+                header = json.loads(f.readline().decode())
+                graph = cls(header['max_distance'])
+                keys = array.array('Q')
+                checksums = array.array('I')
+                keys.fromfile(f, header['nodes'])
+                checksums.fromfile(f, header['nodes'])
+                arrays = [keys, checksums, graph._edges_a, graph._edges_b,
+                          graph._distances]
+                for a in arrays[2:]:
+                    a.fromfile(f, header['edges'])
+            except (ValueError, KeyError, EOFError) as e:
+                raise IOError('Corrupted similarity graph %r: %s' % (path, e))
+        if header['byteorder'] != sys.byteorder:
+            for a in arrays:
+                a.byteswap()
+        graph._nodes = dict(zip(keys, checksums))
+        return graph
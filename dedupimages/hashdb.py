@@ -1,8 +1,26 @@
+import binascii
+import copy
 import hashlib
+import json
 import os
-from itertools import combinations
+import re
+import time
+from itertools import chain, combinations
 
 from dedupimages.imagehash import ImageHash
+from dedupimages import archive
+from dedupimages.filenames import FileNames
+from dedupimages.lsh import digest_key
+from dedupimages.pathindex import PathIndex
+from dedupimages.stats import stats
+
+
+def _hex(digest):
+    return None if digest is None else binascii.hexlify(digest).decode()
+
+
+def _unhex(hexdigest):
+    return None if hexdigest is None else binascii.unhexlify(hexdigest)
 
 
 class HashItem:
@@ -12,26 +30,126 @@ class HashItem:
     - file size
     - first 512 bytes hashed
     - whole content hashed
+    - image properties read from header: dimensions, format, mode,
+      EXIF orientation
     - perceptual image hashes
+    - reasons why perceptual hash could not be computed (per algorithm)
 
     Same content can bear one or more filenames.
 
+    The content is read from file `filename`, or taken from `data`
+    when given (e.g. member of archive).
+
+    Millions of items are held in memory, so the representation is compact:
+    digests are kept as raw bytes (hex strings in API and database file)
+    and file names are stored in :class:`dedupimages.filenames.FileNames`.
+
+    Loaded items are materialized lazily: file names are converted
+    on first access, perceptual hashes of algorithms not requested
+    by :meth:`load` are kept as hex strings, only to be saved again.
+
+    Items in :class:`HashDB` have `item_id`, a number unique in the database
+    (not saved). Search works with the ids, file names are looked up only
+    for reported results, see :attr:`canonical_name`.
+
     """
 
-    def __init__(self, filename=None):
-        self.file_names = {filename} if filename else set()
+    __slots__ = ('_file_names', '_canonical_name', 'item_id', 'file_size',
+                 '_first_512_digest', '_content_digest', 'width', 'height',
+                 'image_format', 'image_mode', 'orientation', 'image_hash',
+                 '_raw_hashes', 'unhashable', '_partial_hash', '_file')
+
+    def __init__(self, filename=None, data=None):
+        self._file_names = (filename,) if filename else ()
+        self._canonical_name = None
+        self.item_id = None
         self.file_size = 0
-        self.first_512_sha256 = None
-        self._content_sha256 = None
+        self._first_512_digest = None
+        self._content_digest = None
+        self.width = None
+        self.height = None
+        self.image_format = None
+        self.image_mode = None
+        self.orientation = None
         self.image_hash = {}
+        self._raw_hashes = None
+        self.unhashable = {}
         self._partial_hash = None
         self._file = None
-        if filename:
+        if data is not None:
+            self.file_size = len(data)
+            content_hash = hashlib.sha256(data[:512])
+            self._first_512_digest = content_hash.digest()
+            content_hash.update(data[512:])
+            self._content_digest = content_hash.digest()
+        elif filename:
             self._file = open(filename, 'rb')
             self.file_size = os.fstat(self._file.fileno()).st_size
             data = self._file.read(512)
+            stats.count('bytes_read', len(data))
             self._partial_hash = hashlib.sha256(data)
-            self.first_512_sha256 = self._partial_hash.hexdigest()
+            self._first_512_digest = self._partial_hash.digest()
+
+    @property
+    def file_names(self) -> FileNames:
+        names = self._file_names
+        if names.__class__ is not FileNames:
+            names = self._file_names = FileNames(names)
+        return names
+
+    @file_names.setter
+    def file_names(self, names):
+        self._file_names = FileNames(names)
+        self._canonical_name = None
+
+    @property
+    def canonical_name(self) -> str:
+        """File name used to report the item: the first one in sorted order.
+
+        It's computed once and kept until the file names change
+        (through :meth:`add_file_name`, :meth:`discard_file_name`
+        or assignment to :attr:`file_names`).
+
+        """
+        if self._canonical_name is None and self._file_names:
+            self._canonical_name = min(self.iter_file_names())
+        return self._canonical_name
+
+    def add_file_name(self, filename):
+        self.file_names.add(filename)
+        if self._canonical_name is not None and \
+                filename < self._canonical_name:
+            self._canonical_name = filename
+
+    def discard_file_name(self, filename):
+        self.file_names.discard(filename)
+        if filename == self._canonical_name:
+            self._canonical_name = None
+
+    @property
+    def name_count(self) -> int:
+        """Number of file names, without materializing them."""
+        return len(self._file_names)
+
+    def iter_file_names(self):
+        """Iterate file names, without materializing them."""
+        return iter(self._file_names)
+
+    def with_file_names(self, file_names):
+        """Return copy of this item with different set of file names.
+
+        Hashes are shared with this item, i.e. hashes added to the copy
+        are also added here.
+
+        """
+        item = copy.copy(self)
+        item.file_names = file_names
+        return item
+
+    def set_image_info(self, info):
+        """Store image properties, see :func:`dedupimages.probe.probe_image`."""
+        (self.width, self.height, self.image_format, self.image_mode,
+         self.orientation) = info
 
     def binary_equal(self, other: 'HashItem', fast=False):
         """Compare binary content.
@@ -43,14 +161,18 @@ class HashItem:
 
         """
         return (self.file_size == other.file_size and
-                self.first_512_sha256 == other.first_512_sha256 and
-                (fast or self.content_sha256 == other.content_sha256))
+                self._first_512_digest == other._first_512_digest and
+                (fast or self.content_digest == other.content_digest))
 
-    def check_file_names(self, path=None, fast=False):
+    def check_file_names(self, path=None, fast=False, members=None):
         """Check files referenced by file names.
 
         Remove file name if file no longer exists or was modified.
 
+        Archive members are looked up in `members` when given (dict of
+        file name -> HashItem, see :meth:`HashDB.read_members`),
+        missing ones are removed. Otherwise, they are read from the archive.
+
         """
         file_names_ok = set()
         for filename in self.file_names:
@@ -59,53 +181,101 @@ class HashItem:
                 continue
             # Open and check content
             try:
-                file_hash = HashItem(filename)
+                if archive.split_member_name(filename)[1] is not None:
+                    if members is not None:
+                        file_hash = members.get(filename)
+                        if file_hash is None:
+                            continue
+                    else:
+                        file_hash = HashItem(filename,
+                                             archive.read_member(filename))
+                else:
+                    file_hash = HashItem(filename)
                 if self.binary_equal(file_hash, fast=fast):
                     file_names_ok.add(filename)
             except IOError:
                 pass
         self.file_names = file_names_ok
 
+    @property
+    def first_512_sha256(self):
+        return _hex(self._first_512_digest)
+
     @property
     def content_sha256(self):
+        return _hex(self.content_digest)
+
+    @property
+    def content_digest(self):
         """Content hash is coputed lazily"""
         if self._file and self._partial_hash:
             while True:
                 data = self._file.read(32 * 1024)
                 if data:
+                    stats.count('bytes_read', len(data))
                     self._partial_hash.update(data)
                 else:
                     break
-            self._content_sha256 = self._partial_hash.hexdigest()
+            self._content_digest = self._partial_hash.digest()
             self._file.close()
             self._file = None
             self._partial_hash = None
-        return self._content_sha256
+        return self._content_digest
 
     def dump(self) -> dict:
         """Dump the attributes into dict for easy serialization."""
         d = {
-            'names': tuple(self.file_names),
+            'names': tuple(self.iter_file_names()),
             'size': self.file_size,
             'first_512b_sha256': self.first_512_sha256,
             'sha256': self.content_sha256,
         }
+        if self.image_format:
+            d['width'] = self.width
+            d['height'] = self.height
+            d['format'] = self.image_format
+            d['mode'] = self.image_mode
+            if self.orientation:
+                d['orientation'] = self.orientation
+        if self._raw_hashes:
+            for name, value in self._raw_hashes.items():
+                d['ph_' + name] = value
         for name, value in self.image_hash.items():
             d['ph_' + name] = str(value)
+        if self.unhashable:
+            d['unhashable'] = self.unhashable
         return d
 
     @classmethod
-    def load(cls, d: dict) -> 'HashItem':
-        """Load the attributes from dict into new instance."""
+    def load(cls, d: dict, algorithms=None) -> 'HashItem':
+        """Load the attributes from dict into new instance.
+
+        Only perceptual hashes of `algorithms` are loaded (all when None),
+        others are kept as they are.
+
+        """
         i = cls()
-        i.file_names = set(d['names'])
+        i._file_names = d['names']
         i.file_size = d['size']
-        i.first_512_sha256 = d['first_512b_sha256']
-        i._content_sha256 = d['sha256']
+        i._first_512_digest = _unhex(d['first_512b_sha256'])
+        i._content_digest = _unhex(d['sha256'])
+        i.width = d.get('width')
+        i.height = d.get('height')
+        i.image_format = d.get('format')
+        i.image_mode = d.get('mode')
+        i.orientation = d.get('orientation')
+        i.unhashable = d.get('unhashable', {})
         for name, value in d.items():
-            if name.startswith('ph_'):
+            if name.startswith('ph_') and value != 'None':
+                # Failed hashes were saved as 'None' by older versions
                 name = name[3:]
-                i.image_hash[name] = ImageHash.get_subclass(name).load(value)
+                if algorithms is None or name in algorithms:
+                    imagehash_class = ImageHash.get_subclass(name)
+                    i.image_hash[name] = imagehash_class.load(value)
+                elif i._raw_hashes is None:
+                    i._raw_hashes = {name: value}
+                else:
+                    i._raw_hashes[name] = value
         return i
 
 
@@ -114,8 +284,48 @@ class HashDB:
     def __init__(self):
         # List of HashItem objects
         self.items = []
+        # Built on first use, then kept up to date by methods of HashDB.
+        # File names of items must not be changed directly while it exists.
+        self._path_index = None
+        # Next item id, see HashItem.item_id
+        self._next_id = 0
+        # Item id -> HashItem, built on first use
+        self._by_id = None
 
-    def add(self, filename, fast_compare=False):
+    @property
+    def path_index(self) -> PathIndex:
+        """Sorted index of file names, values are HashItem objects."""
+        if self._path_index is None:
+            self._path_index = PathIndex((name, item) for item in self.items
+                                         for name in item.iter_file_names())
+        return self._path_index
+
+    def _append(self, item):
+        """Append new `item`, assigning it next item id."""
+        item.item_id = self._next_id
+        self._next_id += 1
+        self.items.append(item)
+        if self._by_id is not None:
+            self._by_id[item.item_id] = item
+
+    def item_by_id(self, item_id) -> HashItem:
+        """Return item with `item_id`, see :attr:`HashItem.item_id`."""
+        if self._by_id is None:
+            self._by_id = {item.item_id: item for item in self.items}
+        return self._by_id[item_id]
+
+    def _add_name(self, item, filename):
+        if filename not in item.file_names:
+            item.add_file_name(filename)
+            if self._path_index is not None:
+                self._path_index.add(filename, item)
+
+    def _remove_name(self, item, filename):
+        item.discard_file_name(filename)
+        if self._path_index is not None:
+            self._path_index.remove(filename, item)
+
+    def add(self, filename, fast_compare=False, data=None):
         """Add `filename` to database.
 
         First, binary content hash is computed, then it's compared to all items
@@ -125,33 +335,151 @@ class HashDB:
         If `fast_compare` is requested, only hash of first 512 bytes and file
         size are compared.
 
+        If `data` is given, it's used as the file content instead of reading
+        the file (`filename` may then refer to archive member).
+
         Returns HashItem object (added or found) with the filename.
 
         """
-        file_hash = HashItem(filename)
-        for item in self.items:
-            if item.binary_equal(file_hash, fast=fast_compare):
-                item.file_names.add(filename)
-                return item
-        self.items.append(file_hash)
-        return file_hash
+        with stats.phase('fingerprint'):
+            stats.count('files')
+            file_hash = HashItem(filename, data)
+            for item in self.items:
+                if item.binary_equal(file_hash, fast=fast_compare):
+                    self._add_name(item, filename)
+                    return item
+            self._append(file_hash)
+            if self._path_index is not None:
+                self._path_index.add(filename, file_hash)
+            return file_hash
+
+    def find_item(self, filename):
+        """Return item with `filename` or None if not found."""
+        return self.path_index.get(filename)
+
+    def items_in_path(self, path) -> list:
+        """Return items with at least one file name starting with `path`."""
+        return self.path_index.values_in_prefix(path)
+
+    def remove_path(self, path, recursive=True):
+        """Remove file names in `path` from items.
+
+        Non-recursive remove keeps files in subdirectories of `path`.
+
+        Returns sorted list of removed file names.
+
+        """
+        removed = []
+        for filename, item in self.path_index.iter_prefix(path):
+            if (recursive or
+                    os.path.dirname(archive.outer_path(filename)) == path):
+                self._remove_name(item, filename)
+                removed.append(filename)
+        return removed
+
+    def check_file_names(self, path=None, fast=False):
+        """Check files in `path` (or all files), see
+        :meth:`HashItem.check_file_names`.
+
+        Returns generator of (item, removed file names) for each checked item.
+
+        """
+        items = self.items_in_path(path) if path else list(self.items)
+        members = self.read_members(items, path)
+        for item in items:
+            original_file_names = set(item.file_names)
+            item.check_file_names(path=path, fast=fast, members=members)
+            removed = original_file_names.difference(item.file_names)
+            if self._path_index is not None:
+                for filename in removed:
+                    self._path_index.remove(filename, item)
+            yield item, sorted(removed)
+
+    @staticmethod
+    def read_members(items, path=None) -> dict:
+        """Read archive members referenced by file names of `items`
+        (only those in `path`).
+
+        Each archive is read once, sequentially. Members are not kept,
+        only their fingerprints (HashItem without image hashes).
+
+        Returns dict of file name -> HashItem for members which were read.
+
+        """
+        # Archive path -> names of members
+        wanted = {}
+        for item in items:
+            for filename in item.iter_file_names():
+                if path and not filename.startswith(path):
+                    continue
+                archive_path, member_name = archive.split_member_name(filename)
+                if member_name is not None:
+                    wanted.setdefault(archive_path, set()).add(member_name)
+        members = {}
+        for archive_path, member_names in wanted.items():
+            try:
+                for member_name, data in archive.iter_members(
+                        archive_path, member_names.__contains__):
+                    filename = archive_path + archive.SEPARATOR + member_name
+                    members[filename] = HashItem(filename, data)
+            except IOError:
+                pass
+        return members
 
     def prune(self):
         """Remove items without file names."""
-        for item in self.items[:]:
-            if not item.file_names:
-                self.items.remove(item)
+        self.items = [item for item in self.items if item.name_count]
+        self._by_id = None
+
+    def add_hashes_from(self, other: 'HashDB'):
+        """Add perceptual hashes and unhashable reasons from items of `other`
+        to items with the same content, where missing.
+
+        Returns number of updated items.
+
+        """
+        by_digest = {item.content_digest: item for item in other.items}
+        updated = 0
+        for item in self.items:
+            source = by_digest.get(item.content_digest)
+            if source is None:
+                continue
+            missing = (source.image_hash.keys() - item.image_hash.keys() or
+                       source.unhashable.keys() - item.unhashable.keys())
+            if missing:
+                for name, imghash in source.image_hash.items():
+                    item.image_hash.setdefault(name, imghash)
+                for name, reason in source.unhashable.items():
+                    item.unhashable.setdefault(name, reason)
+                updated += 1
+        return updated
 
     def filter_by_path(self, path):
         """Keep items with filename in `path`, drop the rest."""
-        filtered_items = []
-        for item in self.items:
-            filtered_names = {name for name in item.file_names
-                              if name.startswith(path)}
-            if filtered_names:
-                item.file_names = filtered_names
-                filtered_items.append(item)
-        self.items = filtered_items
+        self.items = self.filtered_by_path(path).items
+        self._path_index = None
+        self._by_id = None
+
+    def filtered_by_path(self, path) -> 'HashDB':
+        """Return new database with items with filename in `path`.
+
+        The items are copies with file names outside `path` removed,
+        see :meth:`HashItem.with_file_names`. They keep their item ids.
+
+        """
+        selected = []
+        names_by_item = {}
+        for filename, item in self.path_index.iter_prefix(path):
+            names = names_by_item.get(id(item))
+            if names is None:
+                names = names_by_item[id(item)] = []
+                selected.append((item, names))
+            names.append(filename)
+        filtered = HashDB()
+        filtered.items = [item.with_file_names(names)
+                          for item, names in selected]
+        filtered._next_id = self._next_id
+        return filtered
 
     def list_top_paths(self) -> list:
         """Get list of unique top paths of files in database.
@@ -160,105 +488,272 @@ class HashDB:
         all file names in database while having at least one file
         directly in each listed top directory.
 
+        Archive members are accounted as the archive file.
+
         """
+        dirnames = set()
+        last_dirname = None
+        for filename in self.path_index.names():
+            dirname = os.path.dirname(archive.outer_path(filename))
+            # Names are sorted, files from same directory come in a row
+            if dirname != last_dirname:
+                dirnames.add(dirname)
+                last_dirname = dirname
+        # Sorted, each path is directly followed by paths prefixed by it
         paths = []
-        for item in self.items:
-            for filename in item.file_names:
-                dirname = os.path.dirname(filename)
-                for path in paths:
-                    if dirname.startswith(path):
-                        break
-                else:
-                    for path in paths[:]:
-                        if path.startswith(dirname):
-                            paths.remove(path)
-                    paths.append(dirname)
-        paths.sort()
+        for dirname in sorted(dirnames):
+            if not paths or not dirname.startswith(paths[-1]):
+                paths.append(dirname)
         return paths
 
-    def find_pairs(self, threshold, hash_name):
+    def hashed_items(self, hash_name) -> list:
+        """Return list of (item, hash) for items with file names
+        and hash of `hash_name`."""
+        return [(item, item.image_hash[hash_name]) for item in self.items
+                if item.name_count and hash_name in item.image_hash]
+
+    def find_pairs(self, threshold, hash_name, index=None, jobs=1):
         """Find pairs of similar images.
 
-        Returns generator of tuples (fname_a, fname_b, distance):
+        Returns generator of tuples (id_a, id_b, distance):
 
-        * fname_a, fname_b: File names of pair of similar images.
+        * id_a, id_b: Item ids of pair of similar images,
+          see :meth:`item_by_id`.
         * distance: Normalized distance of hashes.
 
-        Returned pairs can be grouped by fname_a without sorting.
+        Returned pairs can be grouped by id_a without sorting.
+
+        With `index` (:class:`dedupimages.lsh.LshIndex` or
+        :class:`dedupimages.graph.SimilarityGraph`), only candidate pairs
+        found in the index are compared. Items missing in the index
+        are not found.
+
+        Without `index`, the comparisons may run in `jobs` processes,
+        see :func:`dedupimages.parallel.find_edges`.
 
         """
-        for item_a, item_b in combinations(self.items, 2):
-            # Need file names for report
-            if not item_a.file_names or not item_b.file_names:
-                continue
-            # Need hashes to compare
-            hash_a = item_a.image_hash.get(hash_name)
-            hash_b = item_b.image_hash.get(hash_name)
-            if not hash_a or not hash_b:
-                continue
-            # Compare and report with one of file names
-            distance = hash_a.distance(hash_b)
-            if distance <= threshold:
-                fname_a = sorted(item_a.file_names)[0]
-                fname_b = sorted(item_b.file_names)[0]
-                yield fname_a, fname_b, distance
-
-    def find_groups(self, threshold, hash_name):
+        entries = self.hashed_items(hash_name)
+        if index is None and jobs > 1 and len(entries) > 1:
+            from dedupimages.parallel import find_edges
+            try:
+                edges = find_edges([imghash for _item, imghash in entries],
+                                   threshold, jobs)
+            except ValueError:
+                pass
+            else:
+                return self._report_edges(entries, edges)
+        return self._compare_pairs(entries, threshold, index)
+
+    @staticmethod
+    def _report_edges(entries, edges):
+        """Turn `edges` (pos_a, pos_b, distance) into pairs of item ids."""
+        count = len(entries)
+        elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            for pos_a, pos_b, distance in edges:
+                id_a = entries[pos_a][0].item_id
+                id_b = entries[pos_b][0].item_id
+                elapsed += time.perf_counter() - start
+                yield id_a, id_b, distance
+                start = time.perf_counter()
+        finally:
+            elapsed += time.perf_counter() - start
+            stats.add_time('compare', elapsed)
+            stats.count('comparisons', count * (count - 1) // 2)
+
+    @staticmethod
+    def _compare_pairs(entries, threshold, index=None):
+        if index is None:
+            candidates = combinations(entries, 2)
+        else:
+            candidates = index.candidate_pairs(entries)
+        # Time spent by the consumer of yielded pairs is not counted
+        comparisons = 0
+        elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            for (item_a, hash_a), (item_b, hash_b) in candidates:
+                comparisons += 1
+                distance = hash_a.distance(hash_b)
+                if distance <= threshold:
+                    elapsed += time.perf_counter() - start
+                    yield item_a.item_id, item_b.item_id, distance
+                    start = time.perf_counter()
+        finally:
+            elapsed += time.perf_counter() - start
+            stats.add_time('compare', elapsed)
+            stats.count('comparisons', comparisons)
+
+    def find_groups(self, threshold, hash_name, index=None, jobs=1):
         """Find groups of similar images, skipping derived pairs.
 
         This builds on :meth:`find_pairs`, additionally grouping the pairs
-        by fname_a and avoiding reports of subsets of already reported pairs.
+        by id_a and avoiding reports of subsets of already reported pairs.
         For example: (x,a), (x,b), ... avoids (a,b) later.
 
-        Returns generator of (fname_a, [(fname_b, distance), ...])
+        Returns generator of (fname_a, [(fname_b, distance), ...]),
+        see :meth:`name_group`.
+
+        For `index` and `jobs`, see :meth:`find_pairs`.
 
         """
-        reported_groups = []
-        current_fname_a = ''
+        pairs = self.find_pairs(threshold, hash_name, index, jobs)
+        for group in self.group_pairs(pairs):
+            yield self.name_group(*group)
+
+    def name_group(self, id_a, group):
+        """Resolve item ids of group from :meth:`group_pairs`
+        to canonical file names.
+
+        Returns (fname_a, [(fname_b, distance), ...]), sorted by fname_b.
+
+        """
+        def name(item_id):
+            return self.item_by_id(item_id).canonical_name
+        return name(id_a), sorted((name(id_b), distance)
+                                  for id_b, distance in group)
+
+    @staticmethod
+    def group_pairs(pairs):
+        """Group `pairs` (a, b, distance) ordered by a,
+        as returned by :meth:`find_pairs`, see :meth:`find_groups`.
+
+        Members of pairs may be item ids or other keys (e.g. positions).
+        Groups are sorted by the keys.
+
+        """
+        # Member -> numbers of reported groups with it
+        member_of = {}
+        reported = 0
+        current_a = None
         current_group = dict()
-        for fname_a, fname_b, distance \
-                in self.find_pairs(threshold, hash_name):
-            for group in reported_groups:
-                if fname_a in group and fname_b in group:
-                    # If both A and B were reported before as duplicates of X,
-                    # skip this pair
-                    break
-            else:
-                if current_fname_a == fname_a:
-                    # Extend current group
-                    current_group[fname_b] = distance
+        for a, b, distance in pairs:
+            groups_a = member_of.get(a)
+            if groups_a and b in member_of and \
+                    not groups_a.isdisjoint(member_of[b]):
+                # If both A and B were reported before as duplicates of X,
+                # skip this pair
+                continue
+            if current_a == a:
+                # Extend current group
+                current_group[b] = distance
+                continue
+            if current_group:
+                # Report previous group...
+                yield current_a, sorted(current_group.items())
+                reported += 1
+                for member in chain((current_a,), current_group):
+                    member_of.setdefault(member, set()).add(reported)
+            # ...and start new one
+            current_a = a
+            current_group = {b: distance}
+        if current_group:
+            yield current_a, sorted(current_group.items())
+
+    def query(self, imghash, threshold, hash_name, index=None):
+        """Find images close to given hash.
+
+        Returns generator of (fname, distance), see :meth:`query_all`.
+
+        """
+        for _key, matches in self.query_all([(None, imghash)], threshold,
+                                            hash_name, index):
+            yield from matches
+
+    def query_all(self, queries, threshold, hash_name, index=None):
+        """Find images close to each hash from `queries`,
+        iterable of (key, imghash).
+
+        Returns generator of (key, [(fname, distance), ...]) for each query.
+        Found images are in database order.
+
+        With `index`, only candidates found in the index are compared,
+        see :meth:`find_pairs`.
+
+        """
+        entries = self.hashed_items(hash_name)
+        if index is not None:
+            # Digest key -> positions of entries
+            positions = {}
+            for pos, (item, _item_hash) in enumerate(entries):
+                positions.setdefault(digest_key(item.content_digest),
+                                     []).append(pos)
+        comparisons = 0
+        try:
+            for key, imghash in queries:
+                if index is None:
+                    candidates = entries
                 else:
-                    if current_fname_a:
-                        # Report previous group...
-                        yield (current_fname_a,
-                               sorted((fn, dist)
-                                      for fn, dist in current_group.items()))
-                        group_set = set(current_group.keys())
-                        group_set.add(current_fname_a)
-                        reported_groups.append(group_set)
-                    # ...and start new one
-                    current_fname_a = fname_a
-                    current_group = {fname_b: distance}
-
-    def query(self, imghash, threshold, hash_name):
-        """Find images close to given hash."""
-        for item in self.items:
-            item_hash = item.image_hash.get(hash_name)
-            distance = imghash.distance(item_hash)
-            if distance <= threshold:
-                fname = sorted(item.file_names)[0]
-                yield fname, distance
+                    found = chain.from_iterable(
+                        positions.get(index.keys[entry_id], ())
+                        for entry_id in index.candidates(bytes(imghash)))
+                    candidates = [entries[pos] for pos in sorted(found)]
+                matches = []
+                for item, item_hash in candidates:
+                    comparisons += 1
+                    distance = imghash.distance(item_hash)
+                    if distance <= threshold:
+                        matches.append((item.canonical_name, distance))
+                yield key, matches
+        finally:
+            stats.count('comparisons', comparisons)
 
     def dump(self) -> list:
         return [item.dump() for item in self.items]
 
     @classmethod
-    def load(cls, l: list) -> 'HashDB':
+    def load(cls, l: list, algorithms=None) -> 'HashDB':
+        """Load items from list of dicts, see :meth:`HashItem.load`."""
         i = cls()
-        i.items = [HashItem.load(d) for d in l]
+        for d in l:
+            i._append(HashItem.load(d, algorithms))
         return i
 
 
+# Whitespace and separators between items of JSON list
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_dumped_items(f, chunk_size=1 << 16):
+    """Generate dumped items (dicts) from database file `f` (text mode).
+
+    The items are decoded one by one, without loading the whole list,
+    see :meth:`HashDB.dump`.
+
+    Raises:
+        ValueError: The file is not a JSON list.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError('Not a JSON list')
+    pos = 1
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos == len(buf):
+            buf = f.read(chunk_size)
+            pos = 0
+            if not buf:
+                raise ValueError('Unexpected end of JSON list')
+            continue
+        if buf[pos] == ']':
+            return
+        while True:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                break
+            except json.JSONDecodeError:
+                # Incomplete item, read more
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+        yield item
+
+
 if __name__ == "__main__":
     # Self test
     hashdb = HashDB()
@@ -1,11 +1,48 @@
-import phash
+import importlib
 import binascii
+import io
+
+
+class _LazyModule:
+
+    """Import module on first attribute access.
+
+    The module then replaces this placeholder in module globals,
+    so there is no overhead afterwards.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+# Not needed for loading and saving hash database
+phash = _LazyModule('phash')
 
 
 class ImageHash:
 
     """ImageHash base class"""
 
+    # Many instances are held in memory, see HashItem
+    __slots__ = ()
+
+    # Cache for get_subclass(): algorithm -> class
+    _subclasses = {}
+
+    # Minimal width and height of image decoded at reduced scale.
+    # Somewhat above the working size of the algorithm.
+    decode_size = 512
+
+    # Approximate peak memory used by pHash for decoding one pixel
+    # of full-size image (source + working copies)
+    decode_bytes_per_pixel = 8
+
     def __init__(self, filename=None):
         if filename:
             self.compute(filename)
@@ -18,9 +55,17 @@ class ImageHash:
             algorithm: Hash algorithm. Refers to algorithm() of ImageHash subclasses.
 
         """
-        for cls in ImageHash.__subclasses__():
+        try:
+            return ImageHash._subclasses[algorithm]
+        except KeyError:
+            pass
+        classes = ImageHash.__subclasses__()
+        while classes:
+            cls = classes.pop()
             if cls.algorithm() == algorithm:
+                ImageHash._subclasses[algorithm] = cls
                 return cls
+            classes.extend(cls.__subclasses__())
         raise ValueError()
 
     @staticmethod
@@ -39,10 +84,50 @@ class ImageHash:
         """
         raise NotImplementedError()
 
+    def compute_reduced(self, filename):
+        """Compute image hash from image decoded at reduced scale.
+
+        Much faster for big images, the result is close, but not always
+        equal to the hash computed by :meth:`compute`.
+
+        Args:
+            filename: Name of image file, or file object.
+
+        Requires PIL.
+
+        """
+        from dedupimages.decode import open_reduced, pixels_file
+        image = open_reduced(filename, self.decode_size)
+        with pixels_file(image) as pixels_filename:
+            self.compute(pixels_filename)
+
+    def compute_buffer(self, data, reduced=False):
+        """Compute image hash from encoded image in memory.
+
+        Args:
+            data: Content of image file (bytes, memoryview).
+            reduced: Decode the image at reduced scale,
+                see :meth:`compute_reduced`.
+
+        Result is saved in this instance.
+
+        """
+        if reduced:
+            self.compute_reduced(io.BytesIO(data))
+            return
+        from dedupimages.decode import buffer_file
+        with buffer_file(data) as filename:
+            self.compute(filename)
+
     def load(self, hexhash):
         """Load hash value from hex string as returned by str()."""
         raise NotImplementedError()
 
+    @classmethod
+    def from_bytes(cls, data):
+        """Create instance from hash value as returned by bytes()."""
+        return cls.load(binascii.hexlify(data).decode())
+
     def distance(self, other):
         """Compute distance between this and another hash.
 
@@ -60,6 +145,14 @@ class DctImageHash(ImageHash):
 
     """DCT image hash algorithm"""
 
+    __slots__ = ('_hash',)
+
+    # Working size is 32x32, keep the 7x7 mean filter small relative to it
+    decode_size = 128
+
+    # Float copies of the full-size image for mean filter
+    decode_bytes_per_pixel = 12
+
     def __init__(self, *args):
         self._hash = 0
         ImageHash.__init__(self, *args)
@@ -83,11 +176,60 @@ class DctImageHash(ImageHash):
     def __str__(self):
         return '%016X' % self._hash
 
+    def __bytes__(self):
+        return self._hash.to_bytes(8, 'big')
+
+
+class ThumbDctImageHash(DctImageHash):
+
+    """DCT image hash of embedded EXIF thumbnail
+
+    Much faster than hashing the full image, as only the first few KB
+    of file are read. Images without the thumbnail are hashed in full.
+    Comparable with :class:`DctImageHash`, but less accurate, so these
+    hashes are meant only for finding candidates of similar images.
+
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def algorithm():
+        return 'dct_thumb'
+
+    def compute(self, filename):
+        if not self._compute_thumbnail(filename):
+            DctImageHash.compute(self, filename)
+
+    def compute_reduced(self, filename):
+        # The thumbnail is smaller than any reduced decode
+        if not (isinstance(filename, str) and
+                self._compute_thumbnail(filename)):
+            DctImageHash.compute_reduced(self, filename)
+
+    def compute_buffer(self, data, reduced=False):
+        if not self._compute_thumbnail(None, data):
+            DctImageHash.compute_buffer(self, data, reduced)
+
+    def _compute_thumbnail(self, filename, data=None):
+        """Compute hash of embedded thumbnail of image in `filename`
+        or `data`. Returns False if there is no thumbnail."""
+        from dedupimages.exif import read_thumbnail
+        thumbnail = read_thumbnail(filename, data)
+        if thumbnail is None:
+            return False
+        from dedupimages.decode import buffer_file
+        with buffer_file(thumbnail) as thumbnail_filename:
+            DctImageHash.compute(self, thumbnail_filename)
+        return True
+
 
 class MhImageHash(ImageHash):
 
     """Marr-Hildreth image hash algorithm"""
 
+    __slots__ = ('_hash',)
+
     def __init__(self, *args):
         self._hash = b''
         ImageHash.__init__(self, *args)
@@ -111,11 +253,19 @@ class MhImageHash(ImageHash):
     def __str__(self):
         return binascii.hexlify(self._hash).upper().decode()
 
+    def __bytes__(self):
+        return self._hash
+
 
 class RadialImageHash(ImageHash):
 
     """Radial variance image hash algorithm"""
 
+    __slots__ = ('_hash',)
+
+    # Float copies of the full-size image for blur and projections
+    decode_bytes_per_pixel = 16
+
     def __init__(self, *args):
         self._hash = b''
         ImageHash.__init__(self, *args)
@@ -139,12 +289,34 @@ class RadialImageHash(ImageHash):
     def __str__(self):
         return binascii.hexlify(self._hash).upper().decode()
 
+    def __bytes__(self):
+        return self._hash
+
+
+def compute_hash(imagehash_class, filepath, reduced=False, data=None,
+                 suffix=None):
+    """Compute hash of image file using the appropriate method.
+
+    If `data` is given, the hash is computed from it, `filepath` is then
+    used only for the report.
+
+    If `suffix` is given, the file is passed to pHash with this suffix,
+    see :func:`dedupimages.decode.suffixed_file`.
+
+    Raises:
+        IOError: Image could not be loaded.
 
-def compute_hash(imagehash_class, filepath):
-    """Helper function which handles errors and prints result."""
-    try:
+    """
+    if data is not None:
+        imghash = imagehash_class()
+        imghash.compute_buffer(data, reduced)
+    elif reduced:
+        imghash = imagehash_class()
+        imghash.compute_reduced(filepath)
+    elif suffix:
+        from dedupimages.decode import suffixed_file
+        with suffixed_file(filepath, suffix) as link_name:
+            imghash = imagehash_class(link_name)
+    else:
         imghash = imagehash_class(filepath)
-    except IOError:
-        return None
-    print(imghash, filepath)
     return imghash
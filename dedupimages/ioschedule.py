@@ -0,0 +1,160 @@
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from dedupimages.stats import stats
+
+
+READ_ORDERS = ('name', 'inode', 'physical')
+
+# ioctl number of FS_IOC_FIEMAP (Linux)
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap: start, length, flags, mapped_extents, extent_count, reserved
+_FIEMAP_HEADER = struct.Struct('=QQIIII')
+# struct fiemap_extent: logical, physical, length, reserved64[2],
+# flags, reserved[3]
+_FIEMAP_EXTENT = struct.Struct('=QQQ2QI3I')
+
+
+def physical_offset(filename):
+    """Return physical offset of the first extent of file on the device.
+
+    Uses FIEMAP ioctl, available on Linux for most local file systems.
+    Returns None when not available (other systems, NFS, empty file).
+
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    _FIEMAP_HEADER.pack_into(request, 0, 0, 0xffffffffffffffff, 0, 0, 1, 0)
+    try:
+        with open(filename, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    mapped_extents = _FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    return _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)[1]
+
+
+def order_reads(filepaths, read_order):
+    """Sort `filepaths` to be read in `read_order`.
+
+    * name: keep the order (sorted by name by the caller)
+    * inode: by device and inode number, which usually follows
+      allocation order on disk
+    * physical: by device and physical offset (see :func:`physical_offset`),
+      files without it come after, by inode
+
+    Files which can't be examined are left at the end.
+
+    """
+    if read_order == 'name':
+        return list(filepaths)
+
+    def locality(filepath):
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return (1,)
+        if read_order == 'physical':
+            offset = physical_offset(filepath)
+            if offset is not None:
+                return 0, st.st_dev, 0, offset
+        return 0, st.st_dev, 1, st.st_ino
+
+    return sorted(filepaths, key=locality)
+
+
+class DeviceLimiter:
+
+    """Limit number of concurrent reads from each device (`max_reads`).
+
+    Spinning disks and NFS servers serve few sequential readers better than
+    many interleaved ones. The limit is independent of the number of threads
+    decoding the images.
+
+    """
+
+    def __init__(self, max_reads):
+        self.max_reads = max_reads
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, device):
+        with self._lock:
+            semaphore = self._semaphores.get(device)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_reads)
+                self._semaphores[device] = semaphore
+            return semaphore
+
+    def read(self, filename) -> bytes:
+        """Read whole content of `filename`.
+
+        Raises:
+            IOError: File could not be read.
+
+        """
+        with open(filename, 'rb') as f:
+            with self._semaphore(os.fstat(f.fileno()).st_dev):
+                return f.read()
+
+
+def read_ahead(filepaths, max_memory, max_reads):
+    """Read content of `filepaths` in background threads.
+
+    Files are read in the given order, with at most `max_reads` at once
+    from each device (see :class:`DeviceLimiter`), as far ahead as their
+    content fits into `max_memory` bytes. The content is handed over
+    (and no longer counted) when yielded.
+
+    Returns generator of (filepath, data) in the order of `filepaths`.
+    Data is None if the file could not be read, the caller should then
+    handle the file as usual.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    limiter = DeviceLimiter(max_reads)
+    # Extra threads wait for their device, while other devices are read
+    with ThreadPoolExecutor(max_workers=max(4, max_reads)) as executor:
+        pending = deque()
+        used = 0
+
+        def finish():
+            filepath, size, future = pending.popleft()
+            start = time.perf_counter()
+            try:
+                data = future.result()
+            except IOError:
+                data = None
+            stats.add_time('read_wait', time.perf_counter() - start)
+            if data is not None:
+                stats.count('bytes_read', len(data))
+            return (filepath, data), size
+
+        try:
+            for filepath in filepaths:
+                try:
+                    size = os.path.getsize(filepath)
+                except OSError:
+                    size = 0
+                while pending and used + size > max_memory:
+                    result, finished_size = finish()
+                    used -= finished_size
+                    yield result
+                pending.append((filepath, size,
+                                executor.submit(limiter.read, filepath)))
+                used += size
+            while pending:
+                yield finish()[0]
+        finally:
+            # Stopped early, don't read the rest
+            for _filepath, _size, future in pending:
+                future.cancel()
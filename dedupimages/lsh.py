@@ -0,0 +1,285 @@
+import array
+import json
+import math
+import random
+import sys
+from bisect import bisect_left
+from itertools import chain
+from operator import itemgetter
+
+from dedupimages.dbfile import atomic_write
+
+
+MAGIC = b'dedup-images lsh 1\n'
+
+# Limits for tuning. Bucket and entry id are packed into 64 bits.
+MAX_TABLES = 64
+MAX_BYTES_PER_TABLE = 4
+
+# Sorted runs of a table are merged when there are more of them
+MAX_RUNS = 4
+
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+
+
+def digest_key(digest) -> int:
+    """Index key of item with content `digest` (first 64 bits of SHA-256)."""
+    return int.from_bytes(digest[:8], 'big')
+
+
+def table_probability(distance, bits):
+    """Probability that hash at normalized Hamming `distance` from query
+    is found in one table with `bits` sampled bits.
+
+    The bucket of the query is probed, along with all buckets
+    differing in one bit.
+
+    """
+    same = 1.0 - distance
+    return same ** bits + bits * distance * same ** (bits - 1)
+
+
+def tune(threshold, recall, items):
+    """Choose parameters of the index.
+
+    Hashes within `threshold` from query should be found with probability
+    at least `recall`. The cost of query is estimated as number of probed
+    buckets plus number of random candidates to be verified, with `items`
+    in the index. The cheapest configuration is chosen.
+
+    Returns:
+        Tuple (bytes_per_table, tables).
+
+    Raises:
+        ValueError: The recall can't be reached with at most `MAX_TABLES`.
+
+    """
+    if not 0.0 < recall < 1.0:
+        raise ValueError('Recall must be between 0 and 1: %s' % recall)
+    best = None
+    for nbytes in range(1, MAX_BYTES_PER_TABLE + 1):
+        bits = 8 * nbytes
+        p = table_probability(threshold, bits)
+        if p >= 1.0:
+            tables = 1
+        else:
+            tables = math.ceil(math.log(1.0 - recall) / math.log(1.0 - p))
+        if tables > MAX_TABLES:
+            continue
+        cost = tables * (bits + 1 + items * table_probability(0.5, bits))
+        if best is None or cost < best[0]:
+            best = cost, nbytes, tables
+    if best is None:
+        raise ValueError('Threshold %s is too loose for LSH index' % threshold)
+    return best[1], best[2]
+
+
+def _make_getter(positions):
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda imghash: (imghash[position],)
+    return itemgetter(*positions)
+
+
+class LshIndex:
+
+    """Locality-sensitive hashing index for Hamming distance of byte hashes
+    (Marr-Hildreth hash, DCT hash).
+
+    Each table samples few bytes of the hash, their bits form the bucket.
+    Lookup probes the bucket of the query and all buckets differing in one
+    bit (multi-probe), so fewer tables are needed. The number of tables
+    and bytes per table are tuned for given `threshold` and `recall`,
+    see :func:`tune`. Found candidates must be verified by exact distance.
+
+    Entries are identified by content SHA-256 of the item, see
+    :func:`digest_key`. Entry ids are assigned sequentially.
+
+    Tables are kept as sorted arrays of ``bucket << 32 | entry_id``,
+    which are loaded from file without creating Python objects. New entries
+    form a new sorted run, runs are merged when there are too many.
+
+    """
+
+    def __init__(self, threshold, recall, capacity, positions):
+        self.threshold = threshold
+        self.recall = recall
+        self.capacity = capacity
+        self.positions = positions
+        self.modified = False
+        self._getters = [_make_getter(p) for p in positions]
+        # Entry id -> digest key
+        self._keys = array.array('Q')
+        # Sorted digest keys (only those already flushed to runs)
+        self._sorted_keys = array.array('Q')
+        self._new_keys = set()
+        self._runs = [[] for _ in positions]
+        self._pending = [[] for _ in positions]
+
+    @classmethod
+    def create(cls, threshold, recall, items, seed=0, hash_bytes=72):
+        """Create empty index tuned for `items` (rounded up to power of ten).
+
+        Args:
+            threshold: Normalized distance of hashes to be found.
+            recall: Probability of finding hash within `threshold`.
+            items: Expected number of entries.
+            seed: Seed for choosing sampled bytes.
+            hash_bytes: Length of indexed hashes.
+
+        """
+        capacity = 10 ** max(3, math.ceil(math.log10(max(items, 1))))
+        nbytes, tables = tune(threshold, recall, capacity)
+        rng = random.Random(seed)
+        positions = [tuple(sorted(rng.sample(range(hash_bytes), nbytes)))
+                     for _ in range(tables)]
+        index = cls(threshold, recall, capacity, positions)
+        index.modified = True
+        return index
+
+    def fits(self, threshold, recall, items):
+        """Check if the index reaches `recall` for `threshold` and `items`."""
+        return (threshold <= self.threshold and recall <= self.recall and
+                items <= self.capacity)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        if key in self._new_keys:
+            return True
+        pos = bisect_left(self._sorted_keys, key)
+        return pos < len(self._sorted_keys) and self._sorted_keys[pos] == key
+
+    @property
+    def keys(self):
+        """Array of digest keys, indexed by entry id."""
+        return self._keys
+
+    def add(self, digest, imghash: bytes):
+        """Add entry for item with content `digest`, unless already present.
+
+        Returns True if added.
+
+        """
+        key = digest_key(digest)
+        if key in self:
+            return False
+        entry_id = len(self._keys)
+        self._keys.append(key)
+        self._new_keys.add(key)
+        for pending, bucket in zip(self._pending, self._buckets(imghash)):
+            pending.append(bucket << _ID_BITS | entry_id)
+        self.modified = True
+        return True
+
+    def candidates(self, imghash: bytes) -> set:
+        """Return set of ids of entries possibly close to `imghash`."""
+        self._flush()
+        found = set()
+        bits = 8 * len(self.positions[0])
+        # No flip (the bucket itself) and flips of each bit
+        flips = [0] + [1 << bit for bit in range(bits)]
+        for runs, bucket in zip(self._runs, self._buckets(imghash)):
+            for flip in flips:
+                low = (bucket ^ flip) << _ID_BITS
+                high = low + (1 << _ID_BITS)
+                for run in runs:
+                    pos = bisect_left(run, low)
+                    # Most of probed buckets are empty
+                    if pos < len(run) and run[pos] < high:
+                        end = bisect_left(run, high, pos)
+                        found.update(value & _ID_MASK
+                                     for value in run[pos:end])
+        return found
+
+    def candidate_pairs(self, entries):
+        """Generate candidate pairs from `entries`, list of (item, hash)
+        as returned by :meth:`dedupimages.hashdb.HashDB.hashed_items`.
+
+        Pairs of entries come in the same order
+        as from :func:`itertools.combinations`.
+
+        """
+        position = {digest_key(item.content_digest): pos
+                    for pos, (item, _imghash) in enumerate(entries)}
+        entry_pos = [position.get(key, -1) for key in self._keys]
+        for pos_a, entry_a in enumerate(entries):
+            found = {entry_pos[entry_id]
+                     for entry_id in self.candidates(bytes(entry_a[1]))}
+            for pos_b in sorted(pos for pos in found if pos > pos_a):
+                yield entry_a, entries[pos_b]
+
+    def stale_count(self, live_keys) -> int:
+        """Count entries with digest key not in set `live_keys`."""
+        return sum(1 for key in self._keys if key not in live_keys)
+
+    def _buckets(self, imghash):
+        return [int.from_bytes(bytes(getter(imghash)), 'big')
+                for getter in self._getters]
+
+    def _flush(self):
+        """Turn pending entries into sorted runs."""
+        if not self._new_keys:
+            return
+        for runs, pending in zip(self._runs, self._pending):
+            runs.append(array.array('Q', sorted(pending)))
+            pending.clear()
+            if len(runs) > MAX_RUNS:
+                runs[:] = [array.array('Q', sorted(chain(*runs)))]
+        self._sorted_keys = array.array(
+            'Q', sorted(chain(self._sorted_keys, self._new_keys)))
+        self._new_keys.clear()
+
+    def save(self, path):
+        self._flush()
+        header = {
+            'threshold': self.threshold,
+            'recall': self.recall,
+            'capacity': self.capacity,
+            'positions': self.positions,
+            'entries': len(self._keys),
+            'runs': [[len(run) for run in runs] for runs in self._runs],
+            'byteorder': sys.byteorder,
+        }
+        with atomic_write(path) as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            self._keys.tofile(f)
+            self._sorted_keys.tofile(f)
+            for run in chain(*self._runs):
+                run.tofile(f)
+        self.modified = False
+
+    @classmethod
+    def load(cls, path) -> 'LshIndex':
+        """Load index saved by :meth:`save`.
+
+        Raises:
+            IOError: File doesn't exist or is not valid.
+
+        """
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise IOError('Not a LSH index: %r' % path)
+            try:
+                header = json.loads(f.readline().decode())
+                index = cls(header['threshold'], header['recall'],
+                            header['capacity'],
+                            [tuple(p) for p in header['positions']])
+                arrays = [index._keys, index._sorted_keys]
+                index._keys.fromfile(f, header['entries'])
+                index._sorted_keys.fromfile(f, header['entries'])
+                for runs, lengths in zip(index._runs, header['runs']):
+                    for length in lengths:
+                        run = array.array('Q')
+                        run.fromfile(f, length)
+                        runs.append(run)
+                        arrays.append(run)
+            except (ValueError, KeyError, EOFError) as e:
+                raise IOError('Corrupted LSH index %r: %s' % (path, e))
+        if header['byteorder'] != sys.byteorder:
+            for a in arrays:
+                a.byteswap()
+        return index
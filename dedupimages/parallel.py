@@ -0,0 +1,126 @@
+import array
+import heapq
+import multiprocessing
+from multiprocessing import shared_memory
+
+from dedupimages.imagehash import ImageHash
+
+
+# Tasks per process, more tasks balance the load better
+TASKS_PER_JOB = 8
+
+# Smaller tiles are not worth the overhead of the task
+MIN_TILE_SIZE = 64
+
+_POS_BITS = 32
+_POS_MASK = (1 << _POS_BITS) - 1
+
+# Shared hashes in worker process: (SharedMemory, width, ImageHash subclass)
+_worker = None
+
+
+def pack_hashes(hashes):
+    """Pack `hashes` into one bytes object, see :meth:`ImageHash.from_bytes`.
+
+    Returns tuple (width, data), where width is length of each hash.
+
+    Raises:
+        ValueError: Hashes differ in length.
+
+    """
+    values = [bytes(imghash) for imghash in hashes]
+    width = len(values[0]) if values else 0
+    if any(len(value) != width for value in values):
+        raise ValueError("Hashes of different length can't be packed")
+    return width, b''.join(values)
+
+
+def split_tiles(count, jobs):
+    """Split comparisons of all pairs of `count` items into tiles.
+
+    The items are split into blocks of equal size. Each tile compares
+    two blocks (a, b) with a <= b, tiles on the diagonal compare one block
+    with itself. There are about `TASKS_PER_JOB` tiles for each job.
+
+    Returns list of rows, each row is list of tiles (lo_a, hi_a, lo_b, hi_b)
+    with the same block a.
+
+    """
+    blocks = 1
+    while (blocks * (blocks + 1) // 2 < jobs * TASKS_PER_JOB and
+           count // (blocks + 1) >= MIN_TILE_SIZE):
+        blocks += 1
+    size = max(1, -(-count // blocks))
+    bounds = [(lo, min(lo + size, count)) for lo in range(0, count, size)]
+    return [[(lo_a, hi_a, lo_b, hi_b) for lo_b, hi_b in bounds[n:]]
+            for n, (lo_a, hi_a) in enumerate(bounds)]
+
+
+def find_edges(hashes, threshold, jobs):
+    """Compare all pairs of `hashes` in `jobs` processes.
+
+    The hashes are packed into shared memory once, workers read them
+    from there. Each worker compares one tile at a time,
+    see :func:`split_tiles`.
+
+    Returns generator of (pos_a, pos_b, distance) for pairs within
+    `threshold`, in the same order as from :func:`itertools.combinations`.
+
+    Raises:
+        ValueError: Hashes can't be packed, see :func:`pack_hashes`.
+
+    """
+    width, data = pack_hashes(hashes)
+    algorithm = type(hashes[0]).algorithm()
+    return _iter_edges(width, data, algorithm, len(hashes), threshold, jobs)
+
+
+def _iter_edges(width, data, algorithm, count, threshold, jobs):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        del data
+        rows = split_tiles(count, jobs)
+        tasks = [(tile, threshold) for row in rows for tile in row]
+        ctx = multiprocessing.get_context()
+        with ctx.Pool(jobs, _attach, (shm.name, width, algorithm)) as pool:
+            # Results come in order of tasks, workers continue meanwhile
+            results = pool.imap(_compare_tile, tasks)
+            for row in rows:
+                row_edges = [zip(*next(results)) for _tile in row]
+                for key, distance in heapq.merge(*row_edges):
+                    yield key >> _POS_BITS, key & _POS_MASK, distance
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _attach(name, width, algorithm):
+    global _worker
+    _worker = (shared_memory.SharedMemory(name=name), width,
+               ImageHash.get_subclass(algorithm))
+
+
+def _load_block(lo, hi):
+    shm, width, imagehash_class = _worker
+    buf = shm.buf
+    return [imagehash_class.from_bytes(buf[pos * width:(pos + 1) * width])
+            for pos in range(lo, hi)]
+
+
+def _compare_tile(task):
+    """Compare items of the tile, return arrays of keys and distances
+    of similar pairs, sorted by key (pos_a << 32 | pos_b)."""
+    (lo_a, hi_a, lo_b, hi_b), threshold = task
+    block_a = _load_block(lo_a, hi_a)
+    block_b = block_a if lo_b == lo_a else _load_block(lo_b, hi_b)
+    keys = array.array('Q')
+    distances = array.array('d')
+    for pos_a in range(lo_a, hi_a):
+        hash_a = block_a[pos_a - lo_a]
+        for pos_b in range(max(lo_b, pos_a + 1), hi_b):
+            distance = hash_a.distance(block_b[pos_b - lo_b])
+            if distance <= threshold:
+                keys.append(pos_a << _POS_BITS | pos_b)
+                distances.append(distance)
+    return keys, distances
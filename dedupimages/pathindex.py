@@ -0,0 +1,80 @@
+from bisect import bisect_left, bisect_right
+
+
+# Sorts after any character which can appear in decoded file name
+_MAX_CHAR = chr(0x10ffff)
+
+
+class PathIndex:
+
+    """Sorted index of file names, each name associated with a value.
+
+    All names under a path prefix are stored next to each other,
+    so selecting a subtree costs O(log n) plus the size of the subtree.
+
+    Same name can be associated with more values (e.g. file which was
+    modified and hashed again, before cleanup of the old reference).
+
+    """
+
+    def __init__(self, entries=()):
+        """Create index from iterable of (name, value)."""
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self._names = [name for name, _value in entries]
+        self._values = [value for _name, value in entries]
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name, value):
+        pos = bisect_right(self._names, name)
+        self._names.insert(pos, name)
+        self._values.insert(pos, value)
+
+    def remove(self, name, value):
+        """Remove association of `name` with `value`, if present."""
+        pos = bisect_left(self._names, name)
+        while pos < len(self._names) and self._names[pos] == name:
+            if self._values[pos] is value:
+                del self._names[pos]
+                del self._values[pos]
+                return
+            pos += 1
+
+    def get(self, name, default=None):
+        """Return first value associated with `name`."""
+        pos = bisect_left(self._names, name)
+        if pos < len(self._names) and self._names[pos] == name:
+            return self._values[pos]
+        return default
+
+    def prefix_range(self, prefix):
+        """Return slice bounds (lo, hi) of names starting with `prefix`."""
+        lo = bisect_left(self._names, prefix)
+        hi = bisect_left(self._names, prefix + _MAX_CHAR, lo)
+        return lo, hi
+
+    def iter_prefix(self, prefix=''):
+        """Generate (name, value) for names starting with `prefix`, sorted."""
+        lo, hi = self.prefix_range(prefix)
+        # Copy, so the caller can modify the index while iterating
+        return zip(self._names[lo:hi], self._values[lo:hi])
+
+    def values_in_prefix(self, prefix=''):
+        """Return list of distinct values of names starting with `prefix`.
+
+        The values are ordered by their first name.
+
+        """
+        lo, hi = self.prefix_range(prefix)
+        seen = set()
+        values = []
+        for value in self._values[lo:hi]:
+            if id(value) not in seen:
+                seen.add(id(value))
+                values.append(value)
+        return values
+
+    def names(self):
+        """Return sorted list of all names (may contain duplicates)."""
+        return list(self._names)
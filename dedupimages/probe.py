@@ -0,0 +1,104 @@
+import io
+import os.path
+from collections import namedtuple
+
+from dedupimages.decode import guess_suffix, pil_image
+from dedupimages.exif import HEADER_SIZE, read_orientation
+
+
+# Image formats decoded by pHash, with file suffix recognized by CImg
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'TIFF': '.tif', 'BMP': '.bmp'}
+
+SUFFIX_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG',
+                  '.tif': 'TIFF', '.tiff': 'TIFF', '.bmp': 'BMP'}
+
+PNG_END = b'IEND\xaeB`\x82'
+
+
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'format', 'mode',
+                                     'orientation'])
+
+
+def _pil_image():
+    """Return PIL.Image module, or None if PIL is not available.
+
+    Imported on first use, it takes a while and it's not needed
+    by most commands.
+
+    """
+    try:
+        return pil_image()
+    except ImportError:
+        return None
+
+
+def probe_image(filename, data=None):
+    """Read image properties from file header, without decoding pixels.
+
+    Format is detected from content, not from file name. Without PIL,
+    only the format and orientation are detected, other properties are None.
+    Orientation is read from EXIF of JPEG files, see
+    :func:`dedupimages.exif.read_orientation`.
+
+    Truncated files are detected only for PNG (by missing end chunk).
+    JPEG files are not checked, valid ones often carry data after
+    the end marker (e.g. video of motion photos), so it may not be
+    at the end of file.
+
+    Args:
+        filename: Name of image file.
+        data: Content of the file, if already in memory.
+
+    Returns:
+        :class:`ImageInfo`
+
+    Raises:
+        IOError: File is not a supported image. The message contains reason.
+
+    """
+    f = io.BytesIO(data) if data is not None else open(filename, 'rb')
+    with f:
+        head = f.read(HEADER_SIZE)
+        if not head:
+            raise IOError('Empty file')
+        Image = _pil_image()
+        if Image is None:
+            suffix = guess_suffix(head[:16])
+            if suffix is None:
+                raise IOError('Not an image')
+            image_format = SUFFIX_FORMATS[suffix]
+            return ImageInfo(None, None, image_format, None,
+                             _orientation(image_format, head))
+        f.seek(0)
+        try:
+            with Image.open(f) as image:
+                info = ImageInfo(image.width, image.height,
+                                 image.format, image.mode,
+                                 _orientation(image.format, head))
+        except IOError:
+            raise IOError('Not an image')
+        if info.format not in FORMATS:
+            raise IOError('Unsupported format %s' % info.format)
+        if info.format == 'PNG':
+            f.seek(-len(PNG_END), os.SEEK_END)
+            if f.read() != PNG_END:
+                raise IOError('Truncated file')
+        return info
+
+
+def _orientation(image_format, head):
+    if image_format != 'JPEG':
+        return None
+    return read_orientation(None, head)
+
+
+def suffix_mismatch(filename, image_format):
+    """Check if file name suffix doesn't correspond to detected format.
+
+    Returns suffix which should be used for the file, or None if it's ok.
+
+    """
+    _root, ext = os.path.splitext(filename)
+    if SUFFIX_FORMATS.get(ext.lower()) == image_format:
+        return None
+    return FORMATS[image_format]
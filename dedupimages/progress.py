@@ -0,0 +1,75 @@
+import sys
+import time
+
+
+class Progress:
+
+    """Single status line with progress, rate and ETA on stderr.
+
+    The line is redrawn at most once per `interval` seconds. When stderr
+    is not a terminal, a new line is written every `log_interval` seconds
+    instead.
+
+    The total may grow while counting (e.g. files found by walking
+    directories). ETA is shown only after the total was set
+    by :meth:`set_total`, which may still be increased by :meth:`add_total`
+    (e.g. by members of archives found later).
+
+    """
+
+    def __init__(self, label, unit='files', enabled=True, interval=0.5,
+                 log_interval=10.0, file=sys.stderr):
+        self.label = label
+        self.unit = unit
+        self.done = 0
+        self.total = 0
+        self.total_final = False
+        self._enabled = enabled
+        self._file = file
+        self._tty = file.isatty()
+        self._interval = interval if self._tty else log_interval
+        self._start = time.monotonic()
+        self._last = 0.0
+        self._line_len = 0
+
+    def add_total(self, n):
+        self.total += n
+
+    def set_total(self, total):
+        self.total = total
+        self.total_final = True
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if self._enabled and now - self._last >= self._interval:
+            self._last = now
+            self._draw(now)
+
+    def finish(self):
+        if not self._enabled or not self._last:
+            return
+        if self._tty:
+            self._file.write('\r' + ' ' * self._line_len + '\r')
+        else:
+            self._draw(time.monotonic())
+        self._file.flush()
+
+    def _draw(self, now):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = '%s: %d' % (self.label, self.done)
+        if self.total:
+            line += '/%d' % self.total
+        line += ' %s, %.1f %s/s' % (self.unit, rate, self.unit)
+        if self.total_final and rate > 0:
+            eta = int((self.total - self.done) / rate)
+            line += ', ETA %d:%02d:%02d' % (eta // 3600, eta // 60 % 60,
+                                            eta % 60)
+        if self._tty:
+            padding = ' ' * max(0, self._line_len - len(line))
+            self._file.write('\r' + line + padding)
+            self._line_len = len(line)
+        else:
+            self._file.write(line + '\n')
+        self._file.flush()
@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import Future
+
+
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(text):
+    """Parse memory size like '512M' or '4G' into number of bytes."""
+    text = text.strip().upper().rstrip('B')
+    unit = SIZE_UNITS.get(text[-1:], None)
+    if unit:
+        text = text[:-1]
+    return int(float(text) * (unit or 1))
+
+
+class DecodeScheduler:
+
+    """Admit decode jobs to executor against memory budget.
+
+    Each job is submitted with estimated memory `cost`. Jobs are started
+    in order of submission as long as their cost fits into remaining
+    budget and there is a free worker. Jobs which don't fit wait, while
+    smaller jobs submitted after them may start. To avoid starvation,
+    waiting job blocks others after being overtaken `max_overtake` times.
+    A job with cost over the whole budget is run alone.
+
+    Without `max_memory`, jobs are passed to executor directly.
+
+    """
+
+    def __init__(self, executor, max_memory, max_jobs, max_overtake=None):
+        self._executor = executor
+        self._max_memory = max_memory
+        self._max_jobs = max_jobs
+        self._max_overtake = max_overtake or 4 * max_jobs
+        self._lock = threading.Lock()
+        self._pending = []
+        self._running = 0
+        self._used = 0
+
+    def submit(self, cost, fn, *args):
+        """Submit job with estimated memory `cost` in bytes.
+
+        Returns :class:`concurrent.futures.Future`.
+
+        """
+        if not self._max_memory:
+            return self._executor.submit(fn, *args)
+        future = Future()
+        with self._lock:
+            self._pending.append([cost, 0, future, fn, args])
+            admitted = self._admit()
+        self._start(admitted)
+        return future
+
+    def _admit(self):
+        """Pick pending jobs to be started. Called with lock held."""
+        admitted = []
+        # Jobs which don't fit, submitted before the current one
+        waiting = []
+        for job in self._pending[:]:
+            if self._running >= self._max_jobs:
+                break
+            cost = job[0]
+            if (self._used + cost <= self._max_memory or
+                    (not self._running and not admitted)):
+                self._pending.remove(job)
+                self._running += 1
+                self._used += cost
+                admitted.append(job)
+                for waiting_job in waiting:
+                    waiting_job[1] += 1
+                continue
+            if job[1] >= self._max_overtake:
+                # Reserve the budget for this job
+                break
+            waiting.append(job)
+        return admitted
+
+    def _start(self, jobs):
+        for cost, _overtaken, future, fn, args in jobs:
+            if not future.set_running_or_notify_cancel():
+                self._finished(cost)
+                continue
+            inner = self._executor.submit(fn, *args)
+            inner.add_done_callback(
+                lambda inner, cost=cost, future=future:
+                self._done(inner, cost, future))
+
+    def _done(self, inner, cost, future):
+        self._finished(cost)
+        exception = inner.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(inner.result())
+
+    def _finished(self, cost):
+        with self._lock:
+            self._running -= 1
+            self._used -= cost
+            admitted = self._admit()
+        self._start(admitted)
@@ -0,0 +1,140 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Stats:
+
+    """Timers, counters and event hooks.
+
+    The module-level :data:`stats` instance collects time spent in program
+    phases (walk, fingerprint, decode, compare, db_load, db_save), counters
+    (files, bytes read, decodes, comparisons, cache hits) and the slowest
+    decoded files.
+
+    Hooks attached by :meth:`Stats.add_hook` are called on events:
+
+    * ``phase_start(name)``, ``phase_end(name, seconds)``
+    * ``file_hashed(filename, seconds)``
+
+    For example, to profile the search (can be put in config file,
+    which is executed as Python code)::
+
+        import cProfile
+        from dedupimages.stats import stats
+        profiler = cProfile.Profile()
+        def profile_search(event, info):
+            if info.get('name') == 'search':
+                if event == 'phase_start':
+                    profiler.enable()
+                elif event == 'phase_end':
+                    profiler.disable()
+                    profiler.dump_stats('/tmp/search.prof')
+        stats.add_hook(profile_search)
+
+    """
+
+    def __init__(self, slowest=10):
+        self.timers = {}
+        self.counters = {}
+        self.slowest = []
+        self._slowest_max = slowest
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Attach `hook(event, info)` to be called on events."""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def emit(self, event, **info):
+        for hook in self._hooks:
+            hook(event, info)
+
+    @contextmanager
+    def phase(self, name):
+        """Measure time spent in the `with` block as phase `name`."""
+        self.emit('phase_start', name=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time(name, seconds)
+            self.emit('phase_end', name=name, seconds=seconds)
+
+    def timed_iter(self, name, iterable):
+        """Iterate `iterable`, measure time spent producing its items
+        as phase `name` (e.g. walking through directories)."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start, calls=0)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def file_hashed(self, filename, seconds):
+        """Record decode time of `filename`."""
+        self.add_time('decode', seconds)
+        self.count('decodes')
+        with self._lock:
+            entry = (seconds, filename)
+            if len(self.slowest) < self._slowest_max:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+        self.emit('file_hashed', filename=filename, seconds=seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            'timers': {name: {'seconds': seconds, 'calls': calls}
+                       for name, (seconds, calls) in self.timers.items()},
+            'counters': dict(self.counters),
+            'slowest_files': [{'filename': filename, 'seconds': seconds}
+                              for seconds, filename
+                              in sorted(self.slowest, reverse=True)],
+        }
+
+    def summary(self) -> str:
+        lines = ['Phases:']
+        for name, (seconds, calls) in self.timers.items():
+            lines.append('  %-12s %10.3f s  (%d calls)' % (name, seconds, calls))
+        lines.append('Counters:')
+        for name, value in self.counters.items():
+            lines.append('  %-12s %10s' % (name, value))
+        if self.slowest:
+            lines.append('Slowest files:')
+            for seconds, filename in sorted(self.slowest, reverse=True):
+                lines.append('  %10.3f s  %s' % (seconds, filename))
+        return '\n'.join(lines)
+
+
+def timed_call(fn, *args):
+    """Call `fn(*args)`, return tuple (result, seconds).
+
+    Module-level function, so it can be sent to worker processes.
+
+    """
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+stats = Stats()
@@ -1,4 +1,6 @@
 import os.path
+import io
+import tempfile
 import tkinter
 import tkinter.messagebox
 from subprocess import Popen, DEVNULL
@@ -6,13 +8,24 @@ from functools import partial
 from collections import namedtuple
 from PIL import Image, ImageTk
 
+from dedupimages import archive
+
 
 class ViewHelper:
 
-    def __init__(self, title, file_list, viewer):
+    def __init__(self, title, file_list, viewer, image_info=None):
+        """Show `file_list` in window.
+
+        `image_info` is optional dict of known image properties per file name,
+        tuples (width, height, format, mode, file size). Those are not read
+        again: the files are then opened only to make their thumbnails,
+        which are loaded after the window is shown.
+
+        """
         self._viewer = viewer
         self._file_list = sorted(file_list)
         self._processes = []
+        self._temp_files = []
         self._want_next = False
 
         root = self.root = tkinter.Tk()
@@ -42,32 +55,32 @@ class ViewHelper:
         lbl_path = self.lbl_path = tkinter.Label(root, text=prefix + "...")
         lbl_path.pack(side=tkinter.TOP, padx=8, pady=8)
 
-        image_info = {}
+        thumbnails = {}
         ImageInfo = namedtuple('ImageInfo', ['image', 'filename', 'filesize',
-                                             'pixelsize', 'imageformat',
-                                             'error'])
+                                             'pixelsize', 'imageformat'])
         for fname in file_list:
-            # Probe image, make thumbnail
-            image = Image.open(fname)
+            if image_info and fname in image_info:
+                # Known properties, open the image later for thumbnail
+                image = None
+                width, height, fmt, mode, size = image_info[fname]
+            else:
+                # Probe image
+                image, size = self._open_image(fname)
+                (width, height), fmt, mode = image.size, image.format, image.mode
             filename = "..." + fname[prefix_len:] if prefix_len > 0 else fname
-            filesize = "{:,} B".format(os.path.getsize(fname))
-            pixelsize = "%s x %s" % image.size
-            imageformat = "%s / %s" % (image.format, image.mode)
-            error = None
-            try:
-                image.thumbnail((128, 128))
-            except OSError as e:
-                error = str(e)
-            image_info[fname] = ImageInfo(image, filename, filesize,
-                                          pixelsize, imageformat, error)
+            filesize = "{:,} B".format(size)
+            pixelsize = "%s x %s" % (width, height)
+            imageformat = "%s / %s" % (fmt, mode)
+            thumbnails[fname] = ImageInfo(image, filename, filesize,
+                                          pixelsize, imageformat)
 
         self.image_frames = []
         for fname in file_list:
-            info = image_info[fname]
+            info = thumbnails[fname]
             d_fsize = any(i.filesize != info.filesize
-                          for i in image_info.values())
+                          for i in thumbnails.values())
             d_psize = any(i.pixelsize != info.pixelsize
-                          for i in image_info.values())
+                          for i in thumbnails.values())
 
             # Frame for image and info
             frm = tkinter.Frame(root, bd=1, relief=tkinter.SUNKEN, height=2)
@@ -76,11 +89,12 @@ class ViewHelper:
             frm.grid_columnconfigure(0, pad=8)
             frm.grid_columnconfigure(2, pad=8)
 
-            # Image button
-            photo_image = frm.ref_photo_image = ImageTk.PhotoImage(info.image)
-            imgbtn = frm.ref_imgbtn = tkinter.Button(frm, image=photo_image)
+            # Image button, thumbnail is loaded when the window is shown
+            imgbtn = frm.ref_imgbtn = tkinter.Button(frm, text="...",
+                                                     width=16, height=8)
             imgbtn["command"] = partial(self._open, fname)
             imgbtn.grid(row=0, rowspan=6, column=0, pady=8)
+            root.after_idle(self._load_thumbnail, frm, fname, info.image)
 
             # Info labels
             def add_info(row, name, value, differs=False):
@@ -97,21 +111,41 @@ class ViewHelper:
             frm.ref_pxsize = add_info(2, "Pixel size:", info.pixelsize, d_psize)
             frm.ref_format = add_info(3, "Format:", info.imageformat)
 
-            # Error message
-            if info.error:
-                label = tkinter.Label(frm, text=info.error, fg="red2")
-                label.grid(row=4, column=1, columnspan=2, sticky=tkinter.NW)
-                frm.ref_error = label
-
             # Delete button
             btn = frm.ref_btn = tkinter.Button(frm)
             btn["text"] = "Delete"
             btn["command"] = partial(self._delete, fname, frm)
+            if self._is_member(fname):
+                # Archive members can't be deleted
+                btn["state"] = 'disabled'
             btn.grid(row=5, column=1, columnspan=2, sticky=tkinter.SW, pady=8)
 
             # Keep references
             self.image_frames.append(frm)
 
+    def _load_thumbnail(self, frm, fname, image=None):
+        """Make thumbnail of `fname` and show it on image button of `frm`."""
+        try:
+            if image is None:
+                image, _size = self._open_image(fname)
+            image.thumbnail((128, 128))
+        except OSError as e:
+            # Error message
+            label = tkinter.Label(frm, text=str(e), fg="red2")
+            label.grid(row=4, column=1, columnspan=2, sticky=tkinter.NW)
+            frm.ref_error = label
+            return
+        photo_image = frm.ref_photo_image = ImageTk.PhotoImage(image)
+        frm.ref_imgbtn.configure(image=photo_image, text='',
+                                 width=0, height=0)
+
+    def _open_image(self, fname):
+        """Open image `fname`, return tuple (PIL image, file size)."""
+        if self._is_member(fname):
+            data = archive.read_member(fname)
+            return Image.open(io.BytesIO(data)), len(data)
+        return Image.open(fname), os.path.getsize(fname)
+
     def main(self):
         self.root.mainloop()
         return self._want_next
@@ -124,9 +158,23 @@ class ViewHelper:
         for p in self._processes:
             p.terminate()
             p.wait()
+        for f in self._temp_files:
+            f.close()
         self.root.destroy()
 
+    @staticmethod
+    def _is_member(filename):
+        return archive.split_member_name(filename)[1] is not None
+
     def _open(self, filename):
+        if self._is_member(filename):
+            # External viewer needs real file, extract the member
+            _root, ext = os.path.splitext(filename)
+            f = tempfile.NamedTemporaryFile(suffix=ext)
+            f.write(archive.read_member(filename))
+            f.flush()
+            self._temp_files.append(f)
+            filename = f.name
         p = Popen([self._viewer, filename], stdout=DEVNULL, stderr=DEVNULL)
         self._processes.append(p)
 
@@ -0,0 +1,191 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import connection
+
+
+class WorkerCrashed(Exception):
+
+    """Worker process died while running the task."""
+
+
+class WorkerTimeout(Exception):
+
+    """Task didn't finish in time, its worker process was killed."""
+
+
+def _worker_main(conn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        fn, args = task
+        try:
+            conn.send((True, fn(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class _Worker:
+
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,),
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.future = None
+        self.started = None
+
+    def run(self, future, fn, args):
+        self.future = future
+        self.started = time.monotonic()
+        self.conn.send((fn, args))
+
+    def finish(self):
+        future, self.future = self.future, None
+        return future
+
+    def crashed(self):
+        code = self.process.exitcode
+        if code is not None and code < 0:
+            return WorkerCrashed('Worker killed by signal %s' % -code)
+        return WorkerCrashed('Worker exited with code %s' % code)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class IsolatedPool:
+
+    """Pool of worker processes for tasks which may crash or hang.
+
+    Each worker runs one task at a time. When the task runs longer than
+    `timeout` seconds, its worker is killed and the future fails with
+    :class:`WorkerTimeout`. When the worker dies (e.g. segfault in C library),
+    the future fails with :class:`WorkerCrashed`. Dead workers are replaced
+    by new ones, other tasks are not affected.
+
+    The interface follows :class:`concurrent.futures.Executor`.
+    Functions and arguments must be picklable.
+
+    """
+
+    def __init__(self, max_workers, timeout=None):
+        self._ctx = multiprocessing.get_context()
+        self._timeout = timeout
+        self._tasks = deque()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = self._ctx.Pipe(duplex=False)
+        self._wakeup_sent = False
+        self._shutdown = False
+        self._workers = [_Worker(self._ctx) for _ in range(max_workers)]
+        self._thread = threading.Thread(target=self._manage, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None)
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new tasks after shutdown')
+            self._tasks.append((future, fn, args))
+        self._wakeup()
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the pool. Waits for submitted tasks if `wait` is set,
+        otherwise cancels them."""
+        with self._lock:
+            self._shutdown = True
+            if not wait:
+                while self._tasks:
+                    self._tasks.popleft()[0].cancel()
+        self._wakeup()
+        self._thread.join()
+        for worker in self._workers:
+            worker.kill()
+
+    def _manage(self):
+        while True:
+            self._dispatch()
+            busy = [w for w in self._workers if w.future]
+            with self._lock:
+                if self._shutdown and not busy and not self._tasks:
+                    return
+            ready = connection.wait([self._wakeup_r] +
+                                    [w.conn for w in busy] +
+                                    [w.process.sentinel for w in busy],
+                                    timeout=self._next_deadline(busy))
+            if self._wakeup_r in ready:
+                with self._lock:
+                    self._wakeup_r.recv()
+                    self._wakeup_sent = False
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        ok, value = worker.conn.recv()
+                    except EOFError:
+                        worker.process.join()
+                        self._replace(worker, worker.crashed())
+                        continue
+                    future = worker.finish()
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                elif worker.process.sentinel in ready:
+                    worker.process.join()
+                    self._replace(worker, worker.crashed())
+                elif self._expired(worker):
+                    self._replace(worker, WorkerTimeout(
+                        'Timeout after %s s' % self._timeout))
+
+    def _wakeup(self):
+        # Keep at most one message in the pipe, so that submit never blocks
+        with self._lock:
+            if not self._wakeup_sent:
+                self._wakeup_sent = True
+                self._wakeup_w.send(None)
+
+    def _dispatch(self):
+        for worker in self._workers:
+            if worker.future:
+                continue
+            with self._lock:
+                if not self._tasks:
+                    return
+                future, fn, args = self._tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                worker.run(future, fn, args)
+            except Exception as e:
+                # Task could not be sent to worker (e.g. pickling error)
+                worker.finish().set_exception(e)
+
+    def _next_deadline(self, busy):
+        if not self._timeout or not busy:
+            return None
+        started = min(w.started for w in busy)
+        return max(0.0, started + self._timeout - time.monotonic())
+
+    def _expired(self, worker):
+        return (self._timeout and
+                time.monotonic() - worker.started >= self._timeout)
+
+    def _replace(self, worker, exception):
+        future = worker.finish()
+        worker.kill()
+        self._workers[self._workers.index(worker)] = _Worker(self._ctx)
+        future.set_exception(exception)